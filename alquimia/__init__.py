@@ -16,6 +16,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+__version__ = '0.7.2'
+
 import os.path
 import sqlalchemy
 import json
@@ -36,4 +38,10 @@ DATA_TYPES = {
     'boolean': sqlalchemy.Boolean
 }
 
+CHUNK_SIZE = 500
+
+FILTERS_CACHE_SIZE = 500
+
+PAGE_SIZE = 100
+
 from alquimia.models import AlquimiaModels
@@ -0,0 +1,135 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from alquimia.models import AlquimiaModels
+from alquimia import CHUNK_SIZE
+
+
+class AlquimiaAsyncModel(object):
+    def __init__(self, models, model):
+        self._models = models
+        self._model = model
+
+    def _apply(self, func, args=(), kwargs={}, callback=None):
+        return self._models._apply(func, args, kwargs, callback)
+
+    def _todict(self, objs, depth, include, fields=None):
+        if isinstance(objs, list):
+            return [obj.todict(depth, include, fields) for obj in objs]
+        return objs.todict(depth, include, fields)
+
+    def _insert(self, objs, depth, include):
+        return self._todict(self._model.insert(objs), depth, include)
+
+    def _update(self, new_values, depth, include):
+        return self._todict(self._model.update(new_values), depth, include)
+
+    def _query(self, filters, depth, include, fields):
+        objs = self._model.query(filters, depth, include, fields).all()
+        return self._todict(objs, depth, include, fields)
+
+    def insert(self, objs, depth=None, include=None, callback=None):
+        return self._apply(self._insert, (objs, depth, include),
+                                                        callback=callback)
+
+    def bulk_insert(self, objs, callback=None, **kwargs):
+        return self._apply(self._model.bulk_insert, (objs,), kwargs, callback)
+
+    def upsert(self, rows, key, callback=None, **kwargs):
+        return self._apply(self._model.upsert, (rows, key), kwargs, callback)
+
+    def update(self, new_values, depth=None, include=None, callback=None):
+        return self._apply(self._update, (new_values, depth, include),
+                                                        callback=callback)
+
+    def delete(self, ids, callback=None):
+        return self._apply(self._model.delete, (ids,), callback=callback)
+
+    def delete_where(self, filters, callback=None):
+        return self._apply(self._model.delete_where, (filters,),
+                                                        callback=callback)
+
+    def query(self, filters={}, depth=None, include=None, fields=None,
+                                                               callback=None):
+        return self._apply(self._query, (filters, depth, include, fields),
+                                                        callback=callback)
+
+    def count(self, filters={}, callback=None):
+        return self._apply(self._model.count, (filters,), callback=callback)
+
+    def exists(self, filters={}, callback=None):
+        return self._apply(self._model.exists, (filters,), callback=callback)
+
+    def aggregate(self, filters={}, callback=None, **kwargs):
+        return self._apply(self._model.aggregate, (filters,), kwargs, callback)
+
+    def _put(self, rows, row, stop):
+        while not stop.is_set():
+            try:
+                rows.put(row, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _produce(self, rows, stop, done, filters, fields, batch_size):
+        try:
+            for row in self._model.stream(filters, fields, batch_size):
+                if not self._put(rows, row, stop):
+                    break
+        finally:
+            self._put(rows, done, stop)
+
+    def stream(self, filters={}, fields=None, batch_size=CHUNK_SIZE):
+        rows = Queue.Queue(batch_size)
+        stop = threading.Event()
+        done = object()
+        result = self._apply(self._produce,
+                             (rows, stop, done, filters, fields, batch_size))
+        try:
+            for row in iter(rows.get, done):
+                yield row
+            result.get()
+        finally:
+            stop.set()
+
+
+class AlquimiaAsyncModels(dict):
+    def __init__(self, db_url, dict_=None, workers=4, **kwargs):
+        kwargs['scoped'] = True
+        self.models = AlquimiaModels(db_url, dict_, **kwargs)
+        self._pool = ThreadPool(workers)
+        for model_name, model in self.models.iteritems():
+            self[model_name] = AlquimiaAsyncModel(self, model)
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.models._session.remove()
+
+    def _apply(self, func, args=(), kwargs={}, callback=None):
+        return self._pool.apply_async(self._run, (func, args, kwargs),
+                                                        callback=callback)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
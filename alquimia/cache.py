@@ -0,0 +1,195 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from sqlalchemy import event
+
+
+class MemoryCache(object):
+    def __init__(self, max_size=1000, max_bytes=64*1024*1024, ttl=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._items = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _pop(self, key):
+        expires, data = self._items.pop(key)
+        self._bytes -= len(data)
+        return expires, data
+
+    def _get(self, key, now):
+        try:
+            expires, data = self._pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires is not None and expires <= now:
+            self.misses += 1
+            return None
+        self._items[key] = (expires, data)
+        self._bytes += len(data)
+        self.hits += 1
+        return data
+
+    def get(self, key):
+        with self._lock:
+            data = self._get(key, time.time())
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            if len(data) > self.max_bytes:
+                return
+            self._items[key] = (expires, data)
+            self._bytes += len(data)
+            while len(self._items) > self.max_size or \
+                                                  self._bytes > self.max_bytes:
+                self._pop(next(iter(self._items)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+            return value
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [self._counters.get(key, 0) for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'max_size': self.max_size,
+                    'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class SharedCache(object):
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, namespace='alquimia', ttl=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        with self._stores_lock:
+            store = self._stores.get(namespace)
+            if store is None:
+                store = self._stores[namespace] = \
+                                {'items': {}, 'lock': threading.Lock()}
+        self._items = store['items']
+        self._lock = store['lock']
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, data = item
+            if expires is not None and expires <= time.time():
+                del self._items[key]
+                return None
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._items[key] = (expires, data)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            expires, data = self._items.get(key, (None, '0'))
+            data = str(int(data) + 1)
+            self._items[key] = (None, data)
+            return int(data)
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [int(self._items.get(key, (None, '0'))[1]) for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'namespace': self.namespace}
+
+
+class CacheInvalidator(object):
+    def __init__(self, cache):
+        self._cache = cache
+
+    def listen(self, session_class):
+        event.listen(session_class, 'after_flush', self._on_flush)
+        event.listen(session_class, 'after_commit', self._on_commit)
+        event.listen(session_class, 'after_rollback', self._on_rollback)
+
+    def _on_flush(self, session, flush_context):
+        touched = session.info.setdefault('alquimia_touched', {})
+        for obj in list(session.new) + list(session.dirty) + \
+                                                     list(session.deleted):
+            ids = touched.setdefault(type(obj).__name__, set())
+            if ids is not None:
+                ids.add(obj.id)
+
+    def _on_commit(self, session):
+        touched = session.info.pop('alquimia_touched', {})
+        for model_name, ids in touched.iteritems():
+            self._cache.incr('alquimia:%s:generation' % model_name)
+            if ids is None:
+                self._cache.incr('alquimia:%s:rows' % model_name)
+                continue
+            for id_ in ids:
+                self._cache.delete('alquimia:%s:%s:version' %
+                                                         (model_name, id_))
+
+    def _on_rollback(self, session):
+        session.info.pop('alquimia_touched', None)
@@ -0,0 +1,180 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from weakref import WeakKeyDictionary
+from sqlalchemy.orm import Query
+from alquimia.utils import log, EventHub
+
+
+def instrumented(method):
+    @wraps(method)
+    def wrapper(cls, *args, **kwargs):
+        with cls._operation_stats.operation(cls.__name__, method.__name__):
+            return method(cls, *args, **kwargs)
+    return wrapper
+
+
+class InstrumentedQuery(Query):
+    _operation_stats = None
+    _alquimia_operation = None
+
+    def _counted_iter(self, rows):
+        count = 0
+        try:
+            for row in rows:
+                count += 1
+                yield row
+        finally:
+            self._operation_stats.fetched(count)
+
+    def _instrumented_iter(self, model_name):
+        with self._operation_stats.operation(model_name, 'query'):
+            for obj in self._counted_iter(Query.__iter__(self)):
+                yield obj
+
+    def __iter__(self):
+        if self._operation_stats is None:
+            return Query.__iter__(self)
+        if self._alquimia_operation is None or self._yield_per:
+            return self._counted_iter(Query.__iter__(self))
+        return self._instrumented_iter(self._alquimia_operation)
+
+
+class EngineHub(EventHub):
+    hubs = WeakKeyDictionary()
+    events = ('after_cursor_execute',)
+
+    def _on_after_cursor_execute(self, conn, cursor, statement, parameters,
+                                                       context, executemany):
+        # rowcount is -1 for SELECT, whose rows are counted as fetched
+        rows = max(cursor.rowcount, 0) if cursor.description is None else 0
+        self._dispatch('_executed', rows)
+
+
+class OperationStats(object):
+    def __init__(self, engine, logger, slow_threshold=None):
+        self._logger = logger
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.callbacks = []
+        self.reset()
+        self.query_cls = type('InstrumentedQuery', (InstrumentedQuery,),
+                                                   {'_operation_stats': self})
+        self._hub = EngineHub.attach(engine, self)
+
+    def detach(self):
+        if self._hub is not None:
+            self._hub.detach(self)
+            self._hub = None
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.statements = 0
+            self.rows = 0
+            self.unattributed_statements = 0
+            self.slow_operations = 0
+
+    def _current(self):
+        return getattr(self._local, 'operation', None)
+
+    def _executed(self, rows):
+        operation = self._current()
+        if operation is not None:
+            operation['statements'] += 1
+            operation['rows'] += rows
+        with self._lock:
+            self.statements += 1
+            self.rows += rows
+            if operation is None:
+                self.unattributed_statements += 1
+
+    def fetched(self, rows):
+        operation = self._current()
+        if operation is not None:
+            operation['rows'] += rows
+        with self._lock:
+            self.rows += rows
+
+    @contextmanager
+    def operation(self, model_name, name):
+        if self._current() is not None:
+            yield
+            return
+        operation = self._local.operation = {'statements': 0, 'rows': 0}
+        start = time.time()
+        error = False
+        try:
+            yield
+        except:
+            error = True
+            raise
+        finally:
+            self._local.operation = None
+            self._record('%s.%s' % (model_name, name), operation,
+                                                   time.time() - start, error)
+            self.after_operation()
+
+    def after_operation(self):
+        if self._current() is not None:
+            return
+        for callback in self.callbacks:
+            callback()
+
+    def _record(self, key, operation, elapsed, error):
+        slow = self.slow_threshold is not None and \
+                                                elapsed >= self.slow_threshold
+        with self._lock:
+            stats = self.operations.get(key)
+            if stats is None:
+                stats = self.operations[key] = {
+                    'calls': 0, 'errors': 0, 'slow': 0, 'total_time': 0.0,
+                    'max_time': 0.0, 'statements': 0, 'rows': 0
+                }
+            stats['calls'] += 1
+            stats['errors'] += error
+            stats['slow'] += slow
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['statements'] += operation['statements']
+            stats['rows'] += operation['rows']
+            self.slow_operations += slow
+        if slow:
+            log(self._logger, 'warning', 'Slow operation %s took %.3fs '
+                                         '(%d statements, %d rows)' % (key,
+                     elapsed, operation['statements'], operation['rows']))
+
+    def snapshot(self):
+        with self._lock:
+            operations = {}
+            for key, stats in self.operations.iteritems():
+                stats = stats.copy()
+                stats['avg_time'] = stats['total_time'] / stats['calls']
+                operations[key] = stats
+            return {
+                'operations': operations,
+                'statements': self.statements,
+                'rows': self.rows,
+                'unattributed_statements': self.unattributed_statements,
+                'slow_operations': self.slow_operations
+            }
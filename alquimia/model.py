@@ -36,6 +36,8 @@ class AlquimiaModel(object):
 
     def __setitem__(self, item, value):
         self._check_attr(item)
+        # objects may come back detached, depending on the session policy
+        self._session.add(self)
         setattr(self, item, value)
 
     def __getitem__(self, item):
@@ -65,31 +67,50 @@ class AlquimiaModel(object):
             raise TypeError("'%s' is not a valid %s attribute!" %
                                               (attr_name, type(self).__name__))
 
-    def todict(self, rec_stack=None):
-        if rec_stack is None:
-            rec_stack = []
-
-        if self in rec_stack:
-            return None
-
+    def _todict_items(self, plan):
+        columns = plan.get(None) if plan is not None else None
+        for prop_name, is_rel in type(self)._get_todict_fields():
+            subplan = None
+            if is_rel and plan is not None:
+                if not prop_name in plan:
+                    continue
+                subplan = plan[prop_name]
+            elif columns is not None and not prop_name in columns:
+                continue
+            prop = self[prop_name]
+            if isinstance(prop, list):
+                for each in prop:
+                    yield prop_name, each, subplan, True
+            elif prop is not None:
+                yield prop_name, prop, subplan, False
+
+    def todict(self, depth=None, include=None, fields=None):
+        with self._operation_stats.operation(type(self).__name__, 'todict'):
+            return self._todict(depth, include, fields)
+
+    def _todict(self, depth, include, fields):
+        plan = None
+        if depth is not None or include is not None or fields is not None:
+            plan = type(self)._load_plan(depth, include, fields)
         dict_ = {}
-        rec_stack.append(self)
-        for prop_name, prop in self.items():
-            if not prop_name.endswith('_id'):
-                if isinstance(prop, list):
-                    propl = []
-                    for each in prop:
-                        each = each.todict(rec_stack)
-                        if each is not None:
-                            propl.append(each)
-                    prop = propl if propl else None
-                
-                elif isinstance(prop, AlquimiaModel):
-                    prop = prop.todict(rec_stack)
-
-                if prop is not None:
-                    dict_[prop_name] = prop
-
+        visited = set([id(self)])
+        stack = [(dict_, self._todict_items(plan))]
+        while stack:
+            parent, items = stack[-1]
+            for prop_name, prop, subplan, in_list in items:
+                if not isinstance(prop, AlquimiaModel):
+                    parent[prop_name] = prop
+                elif not id(prop) in visited:
+                    visited.add(id(prop))
+                    child = {}
+                    if in_list:
+                        parent.setdefault(prop_name, []).append(child)
+                    else:
+                        parent[prop_name] = child
+                    stack.append((child, prop._todict_items(subplan)))
+                    break
+            else:
+                stack.pop()
         return dict_
 
     def has_key(self, key):
@@ -104,7 +125,8 @@ class AlquimiaModel(object):
 
     def remove(self):
         self._session.delete(self)
-        self._session.commit()
+        type(self)._commit()
 
     def save(self):
-        self._session.commit()
+        self._session.add(self)
+        type(self)._commit()
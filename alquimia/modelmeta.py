@@ -16,11 +16,49 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
+import uuid
+import base64
+import hashlib
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import or_
-from alquimia import utils
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy import orm, or_, and_, select, bindparam, false, text, func, \
+                                                                         case
+from alquimia.instrumentation import instrumented
+from alquimia.model import AlquimiaModel
+from alquimia import utils, CHUNK_SIZE, PAGE_SIZE
+
+
+FILTERS_OPERATORS = {
+    '_gt': lambda attr, binds: attr > binds[0],
+    '_gte': lambda attr, binds: attr >= binds[0],
+    '_lt': lambda attr, binds: attr < binds[0],
+    '_lte': lambda attr, binds: attr <= binds[0],
+    '_like': lambda attr, binds: attr.like(binds[0]),
+    '_prefix': lambda attr, binds: attr.like(binds[0], escape='/'),
+    '_in': lambda attr, binds: attr.in_(binds) if binds else false(),
+    '_between': lambda attr, binds: attr.between(*binds),
+    '_is_null': lambda attr, is_null: (attr == None) if is_null \
+                                                         else (attr != None)
+}
+
+AGGREGATE_FUNCTIONS = {
+    'count': func.count,
+    'sum': func.sum,
+    'avg': func.avg,
+    'min': func.min,
+    'max': func.max
+}
+
+SQLITE_MAX_VARIABLES = 999
+
+IDS_STRATEGIES = WeakKeyDictionary()
 
 
 class AlquimiaModelMeta(DeclarativeMeta):
@@ -30,6 +68,7 @@ class AlquimiaModelMeta(DeclarativeMeta):
                                        if isinstance(v, InstrumentedAttribute)}
         cls.__attrs__ = cls.__attributes__ = attrs
         cls._current_pos = 0
+        cls._todict_fields = None
     
     def __getitem__(cls, attr_name):
         try:
@@ -67,6 +106,18 @@ class AlquimiaModelMeta(DeclarativeMeta):
     def iteritems(cls):
         return cls.__attrs__.iteritems
 
+    def _commit(cls):
+        if cls._session.info.get('unit_of_work'):
+            cls._session.flush()
+        else:
+            cls._session.commit()
+
+    def _get_todict_fields(cls):
+        if cls._todict_fields is None:
+            cls._todict_fields = [(k, k in cls.relationships) \
+                                   for k in cls.keys() if not k.endswith('_id')]
+        return cls._todict_fields
+
     def _build_objs(cls, obj):
         if not isinstance(obj, list):
             obj = [obj]
@@ -77,17 +128,21 @@ class AlquimiaModelMeta(DeclarativeMeta):
             objs.append(each)
         return objs
 
-    def _update_rec(cls, new_values, obj):
+    def _update_rec(cls, new_values, obj, objs_map):
         for prop_name, new_value in new_values.iteritems():
             if isinstance(new_value, dict):
-                cls._update_rec(new_value, obj[prop_name])
+                if obj[prop_name] is None:
+                    obj[prop_name] = type(obj)[prop_name].model(**new_value)
+                else:
+                    cls._update_rec(new_value, obj[prop_name], objs_map)
             elif isinstance(new_value, list):
                 new_list = []
                 model = type(obj)[prop_name].model
                 for each_value in new_value:
                     if 'id' in each_value:
-                        each_obj = cls._get_obj_by_id(model, each_value['id'])
-                        cls._update_rec(each_value, each_obj)
+                        each_obj = cls._get_loaded_obj(objs_map, model,
+                                                             each_value['id'])
+                        cls._update_rec(each_value, each_obj, objs_map)
                     else:
                         each_obj = model(**each_value)
                     new_list.append(each_obj)
@@ -101,30 +156,456 @@ class AlquimiaModelMeta(DeclarativeMeta):
         except NoResultFound:
             raise TypeError("invalid id '%s'" % id_)
 
+    def _collect_ids(cls, new_values, model, ids, plans, root=None,
+                                                                   path=()):
+        # plans keeps, per loaded model, the relationships the update walks,
+        # so they are eager loaded instead of lazy loaded once per object
+        root = model if root is None else root
+        # flushing an updated object loads its delete-orphan many-to-one
+        # relationships to find orphans, so they are planned as well
+        for rel_name in model.relationships:
+            prop = model[rel_name].property
+            if prop.direction is MANYTOONE and prop.cascade.delete_orphan:
+                root._plan_path(plans.setdefault(root, {}), path + (rel_name,))
+        for prop_name, new_value in new_values.iteritems():
+            if not prop_name in model or \
+                                not isinstance(new_value, (dict, list)):
+                continue
+            rel_model = model[prop_name].model
+            rel_path = path + (prop_name,)
+            root._plan_path(plans.setdefault(root, {}), rel_path)
+            if isinstance(new_value, dict):
+                cls._collect_ids(new_value, rel_model, ids, plans, root,
+                                                                     rel_path)
+            else:
+                for each_value in new_value:
+                    if 'id' in each_value:
+                        ids.setdefault(rel_model, set()).add(
+                                           cls._normalize_id(each_value['id']))
+                        cls._collect_ids(each_value, rel_model, ids, plans)
+                    else:
+                        cls._collect_ids(each_value, rel_model, ids, {})
+
+    def _normalize_id(cls, id_):
+        try:
+            return int(id_)
+        except (TypeError, ValueError):
+            raise TypeError("invalid id '%s'" % id_)
+
+    def _load_objs(cls, ids, plans, chunk_size):
+        objs_map = {}
+        for model, model_ids in ids.iteritems():
+            model_objs = objs_map[model] = {}
+            options = model._load_options(plans.get(model, {}))
+            for chunk in utils.chunks(list(model_ids), chunk_size):
+                query = cls._session.query(model).filter(model.id.in_(chunk))
+                if options:
+                    query = query.options(*options)
+                for obj in query:
+                    model_objs[obj.id] = obj
+        return objs_map
+
+    def _get_loaded_obj(cls, objs_map, model, id_):
+        try:
+            return objs_map[model][cls._normalize_id(id_)]
+        except KeyError:
+            raise TypeError("invalid id '%s'" % id_)
+
+    @instrumented
     def insert(cls, objs):
         objs_ = cls._build_objs(objs)
-        cls._session.commit()
+        cls._commit()
         if not isinstance(objs, list):
             objs_ = objs_[0]
         return objs_
 
-    def update(cls, new_values):
+    def _flatten_obj(cls, obj, records, assocs):
+        if not isinstance(obj, dict):
+            raise TypeError('%s.bulk_insert just receive dicts!' % cls)
+        if 'id' in obj:
+            raise Exception("Can't add objects with id!")
+        record = {'model': cls, 'values': {}, 'deps': [], 'needs_id': False}
+        records.append(record)
+        for prop_name, prop in obj.iteritems():
+            if not prop_name in cls:
+                raise TypeError("'%s' is not a valid %s attribute!" %
+                                                     (prop_name, cls.__name__))
+            if isinstance(prop, (dict, list)):
+                rel = cls[prop_name].property
+                model = cls[prop_name].model
+                for each in (prop if isinstance(prop, list) else [prop]):
+                    child = model._flatten_obj(each, records, assocs)
+                    cls._link_records(rel, record, child, assocs)
+            else:
+                record['values'][prop_name] = prop
+        return record
+
+    def _link_records(cls, rel, parent, child, assocs):
+        if rel.secondary is not None:
+            deps = [(dest.key, parent, src.key) \
+                                     for src, dest in rel.synchronize_pairs]
+            deps += [(dest.key, child, src.key) \
+                           for src, dest in rel.secondary_synchronize_pairs]
+            assocs.append({'table': rel.secondary, 'deps': deps})
+            parent['needs_id'] = child['needs_id'] = True
+        elif rel.direction is MANYTOONE:
+            for src, dest in rel.synchronize_pairs:
+                parent['deps'].append((dest.key, child, src.key))
+            child['needs_id'] = True
+        else:
+            for src, dest in rel.synchronize_pairs:
+                child['deps'].append((dest.key, parent, src.key))
+            parent['needs_id'] = True
+
+    def _resolve_deps(cls, record):
+        for key, target, target_key in record['deps']:
+            if target_key not in target['values']:
+                return False
+        for key, target, target_key in record['deps']:
+            record['values'][key] = target['values'][target_key]
+        return True
+
+    def _bulk_insert_records(cls, records, chunk_size):
+        session = cls._session
+        while records:
+            batches = {}
+            pending = []
+            for record in records:
+                if cls._resolve_deps(record):
+                    key = (record['model'], record['needs_id'])
+                    batches.setdefault(key, []).append(record['values'])
+                else:
+                    pending.append(record)
+            if len(pending) == len(records):
+                raise TypeError('%s.bulk_insert found circular ' \
+                                                'relationships!' % cls)
+            for (model, needs_id), rows in batches.iteritems():
+                if needs_id:
+                    cls._insert_with_ids(model, rows, chunk_size)
+                    continue
+                for chunk in utils.chunks(rows, chunk_size):
+                    session.bulk_insert_mappings(model, chunk)
+            records = pending
+
+    def _ids_strategy(cls):
+        engine = cls.metadata.bind
+        if engine in IDS_STRATEGIES:
+            return IDS_STRATEGIES[engine]
+        dialect = engine.dialect
+        strategy = None
+        if not dialect.supports_multivalues_insert:
+            # e.g. sqlite < 3.7.11, which only inserts one row per statement
+            IDS_STRATEGIES[engine] = strategy
+            return strategy
+        if dialect.name == 'postgresql' and dialect.implicit_returning:
+            strategy = 'returning'
+        elif dialect.name == 'sqlite':
+            strategy = 'last'
+        elif dialect.name == 'mysql':
+            # consecutive ids for multi-row inserts are only guaranteed by
+            # the "traditional" and "consecutive" auto-increment lock modes
+            mode = engine.scalar('SELECT @@innodb_autoinc_lock_mode')
+            if mode is not None and int(mode) in (0, 1):
+                strategy = 'first'
+        IDS_STRATEGIES[engine] = strategy
+        return strategy
+
+    def _insert_chunk_ids(cls, table, chunk, strategy):
+        statement = table.insert().values(chunk)
+        if strategy == 'returning':
+            statement = statement.returning(table.c.id)
+            return [row[0] for row in cls._session.execute(statement)]
+        result = cls._session.execute(statement)
+        if result.rowcount != len(chunk) or result.lastrowid is None:
+            raise TypeError('%s.bulk_insert could not recover the ids of '
+                                          '%s!' % (cls, table.name))
+        first = result.lastrowid
+        if strategy == 'last':
+            first -= len(chunk) - 1
+        return range(first, first + len(chunk))
+
+    def _insert_with_ids(cls, model, rows, chunk_size):
+        strategy = cls._ids_strategy()
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for columns, group in groups.iteritems():
+            if strategy is None or not columns:
+                # without RETURNING or guaranteed consecutive ids (or with
+                # nothing to insert but defaults) each row is one INSERT
+                for chunk in utils.chunks(group, chunk_size):
+                    cls._session.bulk_insert_mappings(model, chunk,
+                                                      return_defaults=True)
+                continue
+            size = chunk_size
+            if strategy == 'last':
+                size = max(1, min(size, SQLITE_MAX_VARIABLES / len(columns)))
+            for chunk in utils.chunks(group, size):
+                ids = cls._insert_chunk_ids(model.__table__, chunk, strategy)
+                for row, id_ in zip(chunk, ids):
+                    row['id'] = id_
+
+    def _bulk_insert_assocs(cls, assocs, chunk_size):
+        batches = {}
+        for assoc in assocs:
+            row = {key: target['values'][target_key] \
+                                 for key, target, target_key in assoc['deps']}
+            batches.setdefault(assoc['table'], []).append(row)
+        for table, rows in batches.iteritems():
+            for chunk in utils.chunks(rows, chunk_size):
+                cls._session.execute(table.insert(), chunk)
+
+    @instrumented
+    def bulk_insert(cls, objs, chunk_size=CHUNK_SIZE, return_ids=True):
+        objs_ = objs if isinstance(objs, list) else [objs]
+        records = []
+        assocs = []
+        roots = [cls._flatten_obj(obj, records, assocs) for obj in objs_]
+        if return_ids:
+            for root in roots:
+                root['needs_id'] = True
+        try:
+            cls._bulk_insert_records(records, chunk_size)
+            cls._bulk_insert_assocs(assocs, chunk_size)
+            cls._touch([record['model'] for record in records], [])
+        except:
+            cls._session.rollback()
+            raise
+        cls._commit()
+        if not return_ids:
+            return None
+        ids = [root['values']['id'] for root in roots]
+        return ids if isinstance(objs, list) else ids[0]
+
+    @instrumented
+    def update(cls, new_values, chunk_size=CHUNK_SIZE):
         objs = []
         if not isinstance(new_values, list):
             new_values = [new_values]
+        ids = {cls: set()}
+        plans = {}
+        top_ids = []
         for new_value in new_values:
             try:
                 id_ = new_value.pop('id')
             except KeyError:
                 raise KeyError('values must have id property!')
-            obj = cls._get_obj_by_id(cls, id_)
-            cls._update_rec(new_value, obj)
+            id_ = cls._normalize_id(id_)
+            ids[cls].add(id_)
+            top_ids.append(id_)
+            cls._collect_ids(new_value, cls, ids, plans)
+        objs_map = cls._load_objs(ids, plans, chunk_size)
+        for id_, new_value in zip(top_ids, new_values):
+            obj = cls._get_loaded_obj(objs_map, cls, id_)
+            cls._update_rec(new_value, obj, objs_map)
             objs.append(obj)
-        cls._session.commit()
+        cls._commit()
         objs = objs[0] if len(objs) == 1 else objs
         return objs
 
-    def delete(cls, ids):
+    @instrumented
+    def bulk_update(cls, new_values, chunk_size=CHUNK_SIZE):
+        if not isinstance(new_values, list):
+            new_values = [new_values]
+        for new_value in new_values:
+            if not 'id' in new_value:
+                raise KeyError('values must have id property!')
+            for prop_name, prop in new_value.iteritems():
+                if not prop_name in cls.columns:
+                    raise TypeError("'%s' is not a valid %s column!" %
+                                                     (prop_name, cls.__name__))
+        try:
+            for chunk in utils.chunks(new_values, chunk_size):
+                cls._session.bulk_update_mappings(cls, chunk)
+            cls._touch([cls], [value['id'] for value in new_values])
+        except:
+            cls._session.rollback()
+            raise
+        cls._commit()
+
+    def _unique_keys(cls):
+        table = cls.__table__
+        keys = [set(table.primary_key.columns.keys())]
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint):
+                keys.append(set(constraint.columns.keys()))
+        for index in table.indexes:
+            where = [value for name, value in index.dialect_kwargs.items() \
+                                                  if name.endswith('_where')]
+            if index.unique and not any(w is not None for w in where):
+                keys.append(set(c.name for c in index.columns))
+        keys.extend([set([column.name]) for column in table.columns \
+                                                           if column.unique])
+        return keys
+
+    def _is_unique_key(cls, key):
+        return set(key) in cls._unique_keys()
+
+    def _native_upsert(cls, key, rows):
+        dialect = cls.metadata.bind.dialect
+        if dialect.name == 'sqlite':
+            supported = dialect.dbapi.sqlite_version_info >= (3, 24)
+        elif dialect.name == 'postgresql':
+            supported = dialect.server_version_info >= (9, 5)
+        elif dialect.name == 'mysql':
+            # ON DUPLICATE KEY fires on any unique key, so key must be the
+            # only one the rows can collide on
+            key_ = set(key)
+            primary_key = set(cls.__table__.primary_key.columns.keys())
+            given = set([col for row in rows for col in row])
+            supported = all(unique in (key_, primary_key) \
+                                        for unique in cls._unique_keys()) and \
+                        (primary_key <= key_ or not primary_key & given)
+        else:
+            supported = False
+        return supported and cls._is_unique_key(key)
+
+    def _upsert_row(cls, row, defaults):
+        for prop_name, prop in row.iteritems():
+            if not prop_name in cls.columns or isinstance(prop, (dict, list)):
+                return None
+        values = defaults.copy()
+        values.update(row)
+        return values
+
+    def _upsert_defaults(cls):
+        defaults = {}
+        for column in cls.__table__.columns:
+            if column.default is not None:
+                if not column.default.is_scalar:
+                    return None
+                defaults[column.key] = column.default.arg
+        return defaults
+
+    def _upsert_statement(cls, columns, updates, key):
+        dialect = cls.metadata.bind.dialect
+        quote = dialect.identifier_preparer.quote
+        statement = 'INSERT INTO %s (%s) VALUES (%s)' % \
+            (quote(cls.__table__.name), ', '.join(map(quote, columns)),
+             ', '.join([':c%d' % i for i in xrange(len(columns))]))
+        if dialect.name == 'mysql':
+            updates = updates or key[:1]
+            statement += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                ['%s = VALUES(%s)' % (quote(col), quote(col)) \
+                                                         for col in updates])
+        elif updates:
+            statement += ' ON CONFLICT (%s) DO UPDATE SET %s' % \
+                (', '.join(map(quote, key)), ', '.join(
+                    ['%s = excluded.%s' % (quote(col), quote(col)) \
+                                                        for col in updates]))
+        else:
+            statement += ' ON CONFLICT (%s) DO NOTHING' % \
+                                                  ', '.join(map(quote, key))
+        return text(statement)
+
+    def _upsert_native(cls, rows, key, chunk_size):
+        groups = OrderedDict()
+        for values, row in rows:
+            groups.setdefault((tuple(sorted(values)), tuple(sorted(row))),
+                                                     []).append(values)
+        for (columns, row_columns), group in groups.iteritems():
+            updates = [col for col in row_columns if col not in key]
+            statement = cls._upsert_statement(columns, updates, key)
+            params = [{'c%d' % i: values[col] \
+                             for i, col in enumerate(columns)} for values in group]
+            for chunk in utils.chunks(params, chunk_size):
+                cls._session.execute(statement, chunk)
+
+    def _key_filter(cls, key, keys_values):
+        if len(key) == 1:
+            return cls[key[0]].in_([values[0] for values in keys_values])
+        return or_(*[and_(*[cls[col] == value \
+                                        for col, value in zip(key, values)]) \
+                                                    for values in keys_values])
+
+    def _match_keys(cls, key, keys_values, chunk_size):
+        # the database compares the keys, so collations ignoring case or
+        # trailing spaces match the same rows its unique key does
+        if cls.metadata.bind.dialect.name == 'sqlite':
+            chunk_size = min(chunk_size,
+                                   SQLITE_MAX_VARIABLES / (2 * len(key)))
+        matches = {}
+        pending = list(set(keys_values))
+        while pending:
+            matched = {}
+            for chunk in utils.chunks(pending, chunk_size):
+                position = case([(and_(*[cls[col] == value \
+                                        for col, value in zip(key, values)]), i)
+                                          for i, values in enumerate(chunk)])
+                query = cls._session.query(cls.id, position) \
+                                          .filter(cls._key_filter(key, chunk))
+                for id_, i in query:
+                    matched[chunk[i]] = id_
+            if not matched:
+                break
+            matches.update(matched)
+            pending = [values for values in pending if not values in matched]
+        return matches
+
+    def _upsert_ids(cls, keys_values, key, chunk_size):
+        ids = cls._match_keys(key, keys_values, chunk_size)
+        return [ids[values] for values in keys_values]
+
+    def _upsert_objs(cls, rows, key, keys_values, chunk_size):
+        objs = []
+        existing = {}
+        for chunk in utils.chunks(zip(keys_values, rows), chunk_size):
+            matches = cls._match_keys(key,
+                              [values for values, row in chunk], chunk_size)
+            ids = {cls: set(matches.itervalues())}
+            plans = {}
+            for values, row in chunk:
+                cls._collect_ids(row, cls, ids, plans)
+            objs_map = cls._load_objs(ids, plans, chunk_size)
+            for values, row in chunk:
+                obj = existing.get(values)
+                if obj is None and values in matches:
+                    obj = existing[values] = objs_map[cls][matches[values]]
+                if obj is None:
+                    obj = existing[values] = cls(**row)
+                else:
+                    cls._update_rec(row, obj, objs_map)
+                objs.append(obj)
+        cls._session.flush()
+        return [obj.id for obj in objs]
+
+    @instrumented
+    def upsert(cls, rows, key, chunk_size=CHUNK_SIZE, return_ids=True):
+        rows_ = rows if isinstance(rows, list) else [rows]
+        key = key if isinstance(key, list) else [key]
+        for col in key:
+            if not col in cls.columns:
+                raise TypeError("'%s' is not a valid %s column!" %
+                                                           (col, cls.__name__))
+        keys_values = []
+        for row in rows_:
+            try:
+                keys_values.append(tuple([row[col] for col in key]))
+            except KeyError, e:
+                raise KeyError("values must have '%s' property!" % e.message)
+        native = []
+        if cls._native_upsert(key, rows_):
+            defaults = cls._upsert_defaults()
+            if defaults is not None:
+                native = [cls._upsert_row(row, defaults) for row in rows_]
+        try:
+            if native and all(values is not None for values in native):
+                cls._upsert_native(zip(native, rows_), key, chunk_size)
+                cls._touch([cls])
+                ids = cls._upsert_ids(keys_values, key, chunk_size) \
+                                                       if return_ids else None
+            else:
+                ids = cls._upsert_objs(rows_, key, keys_values, chunk_size)
+        except:
+            cls._session.rollback()
+            raise
+        cls._commit()
+        if not return_ids:
+            return None
+        return ids if isinstance(rows, list) else ids[0]
+
+    @instrumented
+    def delete(cls, ids, chunk_size=CHUNK_SIZE):
         session = cls._session
         if not isinstance(ids, list):
             ids = [ids]
@@ -135,28 +616,435 @@ class AlquimiaModelMeta(DeclarativeMeta):
                 session.rollback()
                 raise TypeError('%s.delete just receive ids (integer)!' \
                                 ' No delete operation was done.' % cls)
-            session.query(cls).filter(cls.id == id_).delete()
-        session.commit()
+        count = 0
+        for chunk in utils.chunks(ids, chunk_size):
+            count += session.query(cls).filter(cls.id.in_(chunk)) \
+                                           .delete(synchronize_session=False)
+        cls._touch_cascade(ids)
+        cls._commit()
+        return count
+
+    @instrumented
+    def delete_where(cls, filters):
+        ids = cls.query(filters).with_entities(cls.id).subquery()
+        count = cls._session.query(cls) \
+                             .filter(cls.id.in_(select([ids.c.id]))) \
+                             .delete(synchronize_session=False)
+        cls._touch_cascade()
+        cls._commit()
+        return count
+
+    def _filters_shape(cls, query_dict, values):
+        shape = []
+        for prop_name, prop in sorted(query_dict.iteritems()):
+            if prop_name == '_or' or isinstance(prop, list):
+                prop = [cls._filters_shape(subfilter, values) \
+                                                      for subfilter in prop]
+                shape.append((prop_name, 'or', tuple(prop)))
+            elif cls._is_operators(prop):
+                shape.append((prop_name, 'operators',
+                                      cls._operators_shape(prop, values)))
+            elif isinstance(prop, dict):
+                shape.append((prop_name, cls._filters_shape(prop, values)))
+            elif prop is None:
+                shape.append((prop_name, 'null'))
+            elif isinstance(prop, AlquimiaModel):
+                if prop.id is None:
+                    raise TypeError("'%s' filter must be a persisted %s!" %
+                                              (prop_name, type(prop).__name__))
+                values.append(prop.id)
+                shape.append((prop_name, 'instance'))
+            else:
+                values.append(prop)
+                shape.append((prop_name, 'eq'))
+        return tuple(shape)
 
-    def _parse_filters(cls, query_dict, obj, filters):
-        for prop_name, prop in query_dict.iteritems():
+    def _is_operators(cls, prop):
+        return isinstance(prop, dict) and bool(prop) and \
+                       all(op in FILTERS_OPERATORS for op in prop.iterkeys())
+
+    def _escape_like(cls, value):
+        return value.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+    def _operators_shape(cls, operators, values):
+        shape = []
+        for op, value in sorted(operators.iteritems()):
+            if op == '_is_null':
+                shape.append((op, bool(value)))
+                continue
+            if op == '_prefix':
+                value = [cls._escape_like(value) + '%']
+            elif op not in ('_in', '_between'):
+                value = [value]
+            values.extend(value)
+            shape.append((op, len(value)))
+        return tuple(shape)
+
+    def _new_bind(cls, binds):
+        bind = bindparam('alquimia_%d' % len(binds))
+        binds.append(bind)
+        return bind
+
+    def _parse_operators(cls, attr, operators, filters, binds):
+        for op, value in sorted(operators.iteritems()):
+            if op == '_is_null':
+                filters.append(FILTERS_OPERATORS[op](attr, value))
+                continue
+            size = len(value) if op in ('_in', '_between') else 1
+            if op == '_between' and size != 2:
+                raise TypeError("'_between' must receive two values!")
+            binds_ = [cls._new_bind(binds) for i in xrange(size)]
+            filters.append(FILTERS_OPERATORS[op](attr, binds_))
+
+    def _parse_instance_filter(cls, prop_name, model, entity, filters, binds):
+        rel = model[prop_name]
+        bind = cls._new_bind(binds)
+        if rel.property.direction is MANYTOONE:
+            local = rel.property.local_remote_pairs[0][0]
+            key = orm.class_mapper(model).get_property_by_column(local).key
+            filters.append(getattr(entity, key) == bind)
+        else:
+            attr = getattr(entity, prop_name)
+            exists = attr.any if rel.property.uselist else attr.has
+            filters.append(exists(rel.model.id == bind))
+
+    def _parse_rel_filters(cls, prop_name, prop, model, entity, filters,
+                                                  binds, joins, path, outer):
+        rel = model[prop_name]
+        attr = getattr(entity, prop_name)
+        if isinstance(prop, list):
+            prop = {'_or': prop}
+        if joins is not None and not rel.property.uselist:
+            path = path + (prop_name,)
+            if path in joins:
+                alias = joins[path][0]
+                joins[path][2] = joins[path][2] and outer
+            else:
+                alias = aliased(rel.model)
+                joins[path] = [alias, attr, outer]
+            cls._parse_filters(prop, rel.model, alias, filters, binds,
+                                                            joins, path, outer)
+        else:
+            filters_ = []
+            cls._parse_filters(prop, rel.model, rel.model, filters_, binds)
+            exists = attr.any if rel.property.uselist else attr.has
+            filters.append(exists(and_(*filters_)))
+
+    def _parse_filters(cls, query_dict, model, entity, filters, binds,
+                                          joins=None, path=(), outer=False):
+        for prop_name, prop in sorted(query_dict.iteritems()):
             if prop_name == '_or':
                 filters_ = []
-                [cls._parse_filters(subfilter, obj, filters_) for subfilter in prop]
+                for subfilter in prop:
+                    subfilters = cls._parse_filters(subfilter, model, entity,
+                                              [], binds, joins, path, True)
+                    filters_.append(and_(*subfilters))
                 filters.append(or_(*filters_))
+            elif isinstance(prop, (dict, list)) and \
+                                            not cls._is_operators(prop):
+                cls._parse_rel_filters(prop_name, prop, model, entity,
+                                       filters, binds, joins, path, outer)
+            elif isinstance(prop, AlquimiaModel):
+                cls._parse_instance_filter(prop_name, model, entity, filters,
+                                                                        binds)
             else:
-                if hasattr(obj, 'model'):
-                    obj = obj.model
-                if isinstance(prop, dict):
-                    cls._parse_filters(prop, obj[prop_name], filters)
-                elif isinstance(prop, list):
-                    cls._parse_filters({'_or': prop}, obj[prop_name], filters)
+                attr = getattr(entity, model[prop_name].key)
+                if cls._is_operators(prop):
+                    cls._parse_operators(attr, prop, filters, binds)
+                elif prop is None:
+                    filters.append(attr == None)
                 else:
-                    filter_ = (obj[prop_name] == prop) if not isinstance(prop, str) \
-                        else obj[prop_name].like(prop)
-                    filters.append(filter_)
+                    filters.append(attr == cls._new_bind(binds))
         return filters
 
-    def query(cls, filters={}):
-        filters = cls._parse_filters(filters, cls, [])
-        return cls._session.query(cls).filter(*filters)
+    def _compile_filters(cls, query_dict):
+        values = []
+        shape = cls._filters_shape(query_dict, values)
+        compiled = cls._filters_cache.get(shape)
+        if compiled is None:
+            joins = OrderedDict()
+            filters = cls._parse_filters(query_dict, cls, cls, [], [], joins)
+            compiled = (filters, [tuple(join) for join in joins.values()])
+            cls._filters_cache.set(shape, compiled)
+        params = {'alquimia_%d' % i: value for i, value in enumerate(values)}
+        return compiled + (params,)
+
+    def _plan_path(cls, plan, path, projection=False):
+        model = cls
+        for rel_name in path:
+            if projection:
+                plan.setdefault(None, set())
+            if not rel_name in model.relationships:
+                raise TypeError("'%s' is not a valid %s relationship!" %
+                                                    (rel_name, model.__name__))
+            model = model[rel_name].model
+            plan = plan.setdefault(rel_name, {})
+        return model, plan
+
+    def _plan_fields(cls, plan, fields):
+        for field in fields:
+            path = field.split('.')
+            model, subplan = cls._plan_path(plan, path[:-1], True)
+            subplan.setdefault(None, set())
+            name = path[-1]
+            if name in model.relationships:
+                subplan = subplan.setdefault(name, {})
+                model = model[name].model
+                subplan.setdefault(None, set()).update([field_name \
+                  for field_name, is_rel in model._get_todict_fields() \
+                                                             if not is_rel])
+            elif name in model.columns:
+                subplan[None].add(name)
+            else:
+                raise TypeError("'%s' is not a valid %s attribute!" %
+                                                        (name, model.__name__))
+
+    def _load_plan(cls, depth=None, include=None, fields=None):
+        plan = {}
+        if depth:
+            for rel_name in cls.relationships:
+                plan[rel_name] = cls[rel_name].model._load_plan(depth - 1)
+        for path in include or []:
+            cls._plan_path(plan, path.split('.'))
+        if fields is not None:
+            cls._plan_fields(plan, fields)
+        return plan
+
+    def _load_columns(cls, plan):
+        columns = set(['id']) | plan[None]
+        for rel_name in plan:
+            if rel_name is not None and rel_name+'_id' in cls.columns:
+                columns.add(rel_name+'_id')
+        return [cls[column] for column in sorted(columns)]
+
+    def _load_options(cls, plan, parent_load=None):
+        options = []
+        loader = orm if parent_load is None else parent_load
+        if None in plan:
+            options.append(loader.load_only(*cls._load_columns(plan)))
+        for rel_name, subplan in plan.iteritems():
+            if rel_name is None:
+                continue
+            if rel_name in cls.otm or rel_name in cls.mtm:
+                strategy = 'subqueryload'
+            else:
+                strategy = 'joinedload'
+            load = getattr(loader, strategy)(cls[rel_name])
+            options += cls[rel_name].model._load_options(subplan, load) or \
+                                                                        [load]
+        return options
+
+    def query(cls, filters={}, depth=None, include=None, fields=None):
+        filters, joins, params = cls._compile_filters(filters)
+        query = cls._session.query(cls)
+        for alias, attr, outer in joins:
+            query = query.outerjoin(alias, attr) if outer \
+                                            else query.join(alias, attr)
+        query = query.filter(*filters).params(params)
+        query._alquimia_operation = cls.__name__
+        if depth is not None or include is not None or fields is not None:
+            plan = cls._load_plan(depth, include, fields)
+            query = query.options(*cls._load_options(plan))
+        return query
+
+    @instrumented
+    def count(cls, filters={}):
+        return cls.query(filters).with_entities(func.count(cls.id)).scalar()
+
+    @instrumented
+    def exists(cls, filters={}):
+        return cls._session.query(cls.query(filters).exists()).scalar()
+
+    def _aggregate_columns(cls, metrics):
+        columns = []
+        for field, functions in sorted(metrics.iteritems()):
+            if not field in cls.columns:
+                raise TypeError("'%s' is not a valid %s column!" %
+                                                         (field, cls.__name__))
+            if not isinstance(functions, list):
+                functions = [functions]
+            for function in functions:
+                if not function in AGGREGATE_FUNCTIONS:
+                    raise TypeError("'%s' is not a valid aggregate function!"
+                                                                    % function)
+                columns.append(('%s_%s' % (field, function),
+                                AGGREGATE_FUNCTIONS[function](cls[field])))
+        return columns
+
+    @instrumented
+    def aggregate(cls, filters={}, group_by=None, metrics=None):
+        group_by = cls._get_fields(group_by or [])
+        columns = [(field, cls[field]) for field in group_by]
+        if metrics is None:
+            columns.append(('count', func.count(cls.id)))
+        else:
+            columns += cls._aggregate_columns(metrics)
+        names = [name for name, column in columns]
+        query = cls.query(filters) \
+                   .with_entities(*[column for name, column in columns]) \
+                   .group_by(*[cls[field] for field in group_by]) \
+                   .order_by(*[cls[field] for field in group_by])
+        rows = [dict(zip(names, row)) for row in query]
+        return rows if group_by else rows[0]
+
+    def _get_fields(cls, fields):
+        if fields is None:
+            return [col for col in cls.columns if not col.endswith('_id')]
+        for field in fields:
+            if not field in cls.columns:
+                raise TypeError("'%s' is not a valid %s column!" %
+                                                         (field, cls.__name__))
+        return list(fields)
+
+    def _stream_rows(cls, query, fields):
+        # the session policies wait for open streams, whose cursor would be
+        # closed under them otherwise
+        info = query.session.info
+        info['streams'] = info.get('streams', 0) + 1
+        try:
+            for row in query:
+                yield dict(zip(fields, row))
+        finally:
+            info['streams'] -= 1
+            cls._operation_stats.after_operation()
+
+    def stream(cls, filters={}, fields=None, batch_size=CHUNK_SIZE):
+        fields = cls._get_fields(fields)
+        query = cls.query(filters) \
+                   .with_entities(*[cls[field] for field in fields]) \
+                   .execution_options(stream_results=True) \
+                   .yield_per(batch_size)
+        return cls._stream_rows(query, fields)
+
+    def _parse_order_by(cls, order_by):
+        order = []
+        for col_name in order_by or []:
+            desc = col_name.startswith('-')
+            col_name = col_name.lstrip('-')
+            cls._get_fields([col_name])
+            order.append((col_name, desc))
+        if not 'id' in [col_name for col_name, desc in order]:
+            order.append(('id', False))
+        return order
+
+    def _keyset_filter(cls, order, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise TypeError("invalid cursor '%s'" % cursor)
+        if not isinstance(values, list) or len(values) != len(order):
+            raise TypeError("invalid cursor '%s'" % cursor)
+        filters = []
+        for i, (col_name, desc) in enumerate(order):
+            equals = [cls[col] == value for (col, d), value in \
+                                                   zip(order[:i], values[:i])]
+            next_ = cls[col_name] < values[i] if desc \
+                                              else cls[col_name] > values[i]
+            filters.append(and_(*(equals + [next_])))
+        return or_(*filters)
+
+    @instrumented
+    def paginate(cls, filters={}, order_by=None, page_size=PAGE_SIZE,
+                                                     after=None, fields=None):
+        fields = cls._get_fields(fields)
+        order = cls._parse_order_by(order_by)
+        names = fields + [col_name for col_name, desc in order \
+                                                    if not col_name in fields]
+        query = cls.query(filters) \
+                   .with_entities(*[cls[name] for name in names])
+        if after is not None:
+            query = query.filter(cls._keyset_filter(order, after))
+        query = query.order_by(*[cls[col_name].desc() if desc \
+                                 else cls[col_name].asc() \
+                                 for col_name, desc in order])
+        rows = [dict(zip(names, row)) for row in query.limit(page_size + 1)]
+        cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            values = [rows[-1][col_name] for col_name, desc in order]
+            cursor = base64.urlsafe_b64encode(json.dumps(values))
+        page = [{field: row[field] for field in fields} for row in rows]
+        return page, cursor
+
+    def _touch(cls, models, ids=None):
+        # ids=None means the written rows are unknown, which invalidates every
+        # by-id entry of the models and not only the rows in ids
+        if cls._cache is not None:
+            touched = cls._session.info.setdefault('alquimia_touched', {})
+            for model in models:
+                name = model.__name__
+                if ids is None:
+                    touched[name] = None
+                elif touched.get(name, ()) is not None:
+                    touched.setdefault(name, set()).update(
+                                       [cls._normalize_id(id_) for id_ in ids])
+
+    def _touch_cascade(cls, ids=None):
+        cls._touch([cls], ids)
+        cls._touch([cls[rel_name].model for rel_name in cls.relationships])
+
+    def _related_models(cls, depth):
+        models = set()
+        level = [cls]
+        while level and (depth is None or depth > 0):
+            next_level = []
+            for model in level:
+                for rel_name in model.relationships:
+                    rel_model = model[rel_name].model
+                    if not rel_model in models:
+                        models.add(rel_model)
+                        next_level.append(rel_model)
+            level = next_level
+            depth = None if depth is None else depth - 1
+        return models
+
+    def _row_version(cls, id_):
+        key = 'alquimia:%s:%s:version' % (cls.__name__, id_)
+        version = cls._cache.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cls._cache.set(key, version)
+        return version
+
+    def _cache_key(cls, kind, value, depth):
+        models = cls._related_models(depth)
+        if kind == 'id':
+            # writes to other rows of the model keep this entry valid
+            value = cls._normalize_id(value)
+            counters = ['alquimia:%s:rows' % cls.__name__]
+            versions = [cls._row_version(value)]
+        else:
+            # the filters shape and its values are the normalized form of
+            # the filters, model instances included
+            values = []
+            value = (cls._filters_shape(value, values), values)
+            models.add(cls)
+            counters = []
+            versions = []
+        names = sorted([model.__name__ for model in models])
+        counters.extend(['alquimia:%s:generation' % name for name in names])
+        versions.extend(cls._cache.get_counters(counters))
+        dump = repr([kind, value, depth])
+        return 'alquimia:%s:%s:%s' % (cls.__name__,
+                                   '.'.join(map(str, versions)),
+                                   hashlib.sha1(dump).hexdigest())
+
+    def get_cached(cls, id_, depth=None):
+        if cls._cache is None:
+            return cls._get_obj_by_id(cls, id_).todict(depth)
+        key = cls._cache_key('id', id_, depth)
+        value = cls._cache.get(key)
+        if value is None:
+            value = cls._get_obj_by_id(cls, id_).todict(depth)
+            cls._cache.set(key, value)
+        return value
+
+    def query_cached(cls, filters={}, depth=None):
+        if cls._cache is None:
+            return [obj.todict(depth) for obj in cls.query(filters, depth)]
+        key = cls._cache_key('query', filters, depth)
+        value = cls._cache.get(key)
+        if value is None:
+            value = [obj.todict(depth) for obj in cls.query(filters, depth)]
+            cls._cache.set(key, value)
+        return value
@@ -17,51 +17,152 @@
 
 
 import logging
-from sqlalchemy import create_engine
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.orm import ColumnProperty
 from alquimia.model import AlquimiaModel
 from alquimia.modelmeta import AlquimiaModelMeta
 from alquimia.models_attrs import ModelsAttributes
 from alquimia.models_attrs_reflect import ModelsAtrrsReflect
-from alquimia import DATA_TYPES
+from alquimia.pool import PoolStats, ping_connection
+from alquimia.instrumentation import OperationStats
+from alquimia.cache import CacheInvalidator
+from alquimia.session import SessionLifecycle
+from alquimia.utils import LRUCache
+from alquimia import DATA_TYPES, FILTERS_CACHE_SIZE
 
 
 class AlquimiaModels(dict):
     def __init__(self, db_url, dict_=None, data_types=DATA_TYPES,
-                                                 create=False, logger=logging):
-        engine = create_engine(db_url)
+                 create=False, logger=logging, scoped=False, scopefunc=None,
+                 engine_kwargs=None, filters_cache_size=FILTERS_CACHE_SIZE,
+                 cache_definitions=False, cache_dir=None, reflect_only=None,
+                 reflect_pattern=None, lazy=False, reflect_snapshot=None,
+                 slow_threshold=None, cache=None, session_policy='shared',
+                 max_identity_map=None):
+        engine = self._build_engine(db_url, engine_kwargs)
+        self.pool_stats = PoolStats(engine)
+        self.operation_stats = OperationStats(engine, logger, slow_threshold)
         base_model = declarative_base(engine, metaclass=AlquimiaModelMeta,
                          cls=AlquimiaModel, constructor=AlquimiaModel.__init__)
-        self._session_class = sessionmaker(engine)
-        self._session = self._session_class()
+        self._session_class = sessionmaker(engine,
+                                  query_cls=self.operation_stats.query_cls,
+                                  expire_on_commit=session_policy == 'shared')
+        self.cache = cache
+        if cache is not None:
+            CacheInvalidator(cache).listen(self._session_class)
+        self._scoped = scoped
+        self._filters_cache_size = filters_cache_size
+        if scoped:
+            self._session = scoped_session(self._session_class, scopefunc)
+        else:
+            self._session = self._session_class()
+        self.session_lifecycle = SessionLifecycle(self._session,
+                                         session_policy, max_identity_map)
+        self.session_lifecycle.listen(self._session_class)
+        self.operation_stats.callbacks.append(
+                                    self.session_lifecycle.after_operation)
         self.metadata = base_model.metadata
         if dict_ is not None:
-            attrs = ModelsAttributes(dict_, self.metadata, data_types, logger)
+            attrs = ModelsAttributes(dict_, self.metadata, data_types, logger,
+                                     cache_definitions, cache_dir)
         else:
-            attrs = ModelsAtrrsReflect(self.metadata, logger)
+            attrs = ModelsAtrrsReflect(self.metadata, logger, reflect_only,
+                                  reflect_pattern, lazy, reflect_snapshot)
+        self._base_model = base_model
+        self._attrs = attrs
+        self._lazy = lazy
+        self._lazy_lock = threading.RLock()
         self._build(base_model, attrs)
         if create:
             self.metadata.create_all()
 
-    def _build(self, base_model, models_attrs):
+    def _build_engine(self, db_url, engine_kwargs):
+        engine_kwargs = dict(engine_kwargs or {})
+        pool_pre_ping = engine_kwargs.pop('pool_pre_ping', False)
+        if isinstance(db_url, Engine):
+            if engine_kwargs:
+                raise TypeError('engine_kwargs can not be used with an Engine!')
+            engine = db_url
+        else:
+            engine = create_engine(db_url, **engine_kwargs)
+        if pool_pre_ping:
+            event.listen(engine, 'engine_connect', ping_connection)
+        return engine
+
+    def _build(self, base_model, models_attrs, models_names=None):
+        if models_names is None:
+            models_names = models_attrs.keys()
         models = {}
-        for model_name, attrs in models_attrs.iteritems():
-            attrs.update({'_session': self._session})
+        for model_name in models_names:
+            attrs = models_attrs[model_name]
+            attrs.update({'_session': self._session,
+                  '_filters_cache': LRUCache(self._filters_cache_size),
+                  '_operation_stats': self.operation_stats,
+                  '_cache': self.cache})
             model = type(model_name, (base_model,), attrs)
             models[model_name] = model
+        self.update(models)
+
+        for model in dict.values(self):
+            if model.__name__ not in models:
+                self._add_new_relationships(model, models_attrs)
 
         for model in models.values():
             model.__mapper__.relationships
             for attr_name, attr in model.iteritems():
                 if isinstance(attr.prop, RelationshipProperty):
-                    setattr(attr, 'model', models[attr_name])
+                    setattr(attr, 'model', self[attr_name])
                 else:
                     model.columns.append(attr_name)
 
-        self.update(models)
+    def _add_new_relationships(self, model, models_attrs):
+        for rel_name in model.relationships:
+            if rel_name not in model:
+                setattr(model, rel_name, models_attrs[model.__name__][rel_name])
+                attr = getattr(model, rel_name)
+                attr.model = self[rel_name]
+                model.__attrs__[rel_name] = attr
+                model._todict_fields = None
+
+    def __missing__(self, model_name):
+        if not self._lazy:
+            raise KeyError(model_name)
+        with self._lazy_lock:
+            if not dict.__contains__(self, model_name):
+                models_names = self._attrs.reflect([model_name])
+                if model_name not in models_names:
+                    raise KeyError(model_name)
+                self._build(self._base_model, self._attrs, models_names)
+        return dict.__getitem__(self, model_name)
+
+    def filters_cache_stats(self):
+        return {model_name: model._filters_cache.stats() \
+                                   for model_name, model in self.iteritems()}
 
     def clean(self):
         self._session.expunge_all()
+
+    @contextmanager
+    def unit_of_work(self):
+        session = self._session
+        info = session.info
+        info['unit_of_work'] = info.get('unit_of_work', 0) + 1
+        try:
+            yield session
+            if info['unit_of_work'] == 1:
+                session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            info['unit_of_work'] -= 1
+            if not info['unit_of_work']:
+                self.session_lifecycle.after_operation()
+                if self._scoped:
+                    session.remove()
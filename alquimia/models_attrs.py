@@ -19,10 +19,13 @@
 import jsonschema
 import logging
 import copy
+import json
+import hashlib
+import os
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, ForeignKey, Table
-from alquimia import SCHEMA, DATA_TYPES
-from alquimia.utils import log
+from sqlalchemy import Column, ForeignKey, Table, Index, text
+from alquimia import SCHEMA, DATA_TYPES, __version__
+from alquimia.utils import log, load_pickle, dump_pickle
 from alquimia.models_attrs_reflect import ModelsAtrrsReflect
 
 
@@ -34,26 +37,68 @@ class AmbiguousRelationshipsError(Exception):
         Exception.__init__(self, message)
 
 
+_DEFINITIONS = {}
+
+PARTIAL_INDEX_DIALECTS = ('sqlite', 'postgresql')
+
+
 class ModelsAttributes(ModelsAtrrsReflect):
-    def __init__(self, dict_, metadata, data_types=DATA_TYPES, logger=logging):
+    def __init__(self, dict_, metadata, data_types=DATA_TYPES, logger=logging,
+                                                cache=False, cache_dir=None):
+        self._data_types = data_types
+        ModelsAtrrsReflect.__init__(self, metadata, logger,
+                                                   *[dict_, cache, cache_dir])
+
+    def _definition_key(self, dict_):
+        dump = json.dumps(dict_, sort_keys=True)
+        return hashlib.sha1(dump + __version__).hexdigest()
+
+    def _get_definition(self, dict_, cache, cache_dir):
+        if not cache and cache_dir is None:
+            return self._normalize(dict_)
+        key = self._definition_key(dict_)
+        definition = _DEFINITIONS.get(key)
+        if definition is not None:
+            return definition
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'alquimia-%s.pickle' % key)
+            definition = load_pickle(path, self._logger,
+                                     'models definition cache')
+        if definition is None:
+            definition = self._normalize(dict_)
+            if path is not None:
+                dump_pickle(path, definition)
+        _DEFINITIONS[key] = definition
+        return definition
+
+    def _normalize(self, dict_):
         dict_ = copy.deepcopy(dict_)
         jsonschema.validate(dict_, SCHEMA)
-        self._data_types = data_types
-        ModelsAtrrsReflect.__init__(self, metadata, logger, *[dict_])
-
-    def _build_columns(self, model_name, model):
-        new_model = {}
-        for k, v in model.iteritems():
-            new_model[k] = type(v)(v)
-        model = new_model
-        model.pop('relationships', None)
-        model['id'] = {'type': 'integer', 'primary_key': True}
-        for col_name, column in model.iteritems():
-            if not isinstance(column, dict):
-                type_ = column
-                column = {'args': [col_name, type_]}
-            else:
-                column['args'] = [col_name, column.pop('type')]
+        models_rels = {}
+        for model_name, model in dict_.iteritems():
+            rels = model.pop('relationships', {})
+            models_rels[model_name] = self._build_relationships_dict(rels)
+        self._check_rels(models_rels)
+
+        definition = {}
+        for model_name, model in dict_.iteritems():
+            indexes = model.pop('indexes', [])
+            model['id'] = {'type': 'integer', 'primary_key': True}
+            for col_name, column in model.iteritems():
+                if not isinstance(column, dict):
+                    model[col_name] = {'type': column}
+            definition[model_name] = {
+                'columns': model,
+                'relationships': models_rels[model_name],
+                'indexes': indexes
+            }
+        return definition
+
+    def _build_columns(self, model_name, columns):
+        for col_name, column in columns.iteritems():
+            column = column.copy()
+            column['args'] = [col_name, column.pop('type')]
             self._build_column_instance(column, col_name, model_name)
 
     def _build_rel_attr_dict(self, new_rels, rel):
@@ -89,12 +134,14 @@ class ModelsAttributes(ModelsAtrrsReflect):
             column['primary_key'] = True
         if oto:
             column['unique'] = True
+        else:
+            column['index'] = True
         self._build_column_instance(column, rel_col_name, model_name)
 
     def _build_relationships(self, model_name, rels_dict):
         rels = {}
         for rel_name, rel in rels_dict.iteritems():
-            if rel.pop('many-to-many', False):
+            if rel.get('many-to-many', False):
                 mtm_table_name = '%s_%s_association' % \
                                                      (model_name, rel_name)
                 self._build_many_to_many_table(model_name, rel_name,
@@ -102,9 +149,9 @@ class ModelsAttributes(ModelsAtrrsReflect):
                 self._build_many_to_many_rel(rel_name,
                                                 model_name, mtm_table_name)
             else:
-                is_oto = rel.pop('one-to-one', False) or rel_name == model_name
+                is_oto = rel.get('one-to-one', False) or rel_name == model_name
                 self._build_relationship_column(rel_name, model_name,
-                                         rel.pop('primary_key', False), is_oto)
+                                         rel.get('primary_key', False), is_oto)
                 if is_oto:
                     id_column = self[model_name]['id'] \
                                             if rel_name == model_name else None
@@ -126,9 +173,36 @@ class ModelsAttributes(ModelsAtrrsReflect):
            primary_key=True, autoincrement=False)
         col2 = Column(rel1_name+'_id', self._data_types['integer'],
            ForeignKey(rel1_name+'.id', onupdate='CASCADE', ondelete='CASCADE'),
-           primary_key=True, autoincrement=False)
+           primary_key=True, autoincrement=False, index=True)
         Table(table_name, self._metadata, col1, col2)
 
+    def _build_index(self, model_name, index):
+        if not isinstance(index, dict):
+            index = {'columns': index}
+        else:
+            index = index.copy()
+        columns = index.pop('columns')
+        if not isinstance(columns, list):
+            columns = [columns]
+        name = index.pop('name', None) or \
+                                  'ix_%s_%s' % (model_name, '_'.join(columns))
+        where = index.pop('where', None)
+        if where is not None:
+            bind = self._metadata.bind
+            dialects = PARTIAL_INDEX_DIALECTS if bind is None \
+                                                  else [bind.dialect.name]
+            for dialect in dialects:
+                if not dialect in PARTIAL_INDEX_DIALECTS:
+                    raise TypeError("index '%s' with 'where' is not supported "
+                                    "by %s!" % (name, dialect))
+                index[dialect + '_where'] = text(where)
+        return Index(name, *columns, **index)
+
+    def _build_indexes(self, model_name, indexes):
+        if indexes:
+            self[model_name]['__table_args__'] = tuple(
+                [self._build_index(model_name, index) for index in indexes])
+
     def _check_rels(self, models_rels):
         new_mr = {m: r.copy() for m, r in models_rels.iteritems()}
         for mdl_name, rels in models_rels.iteritems():
@@ -149,15 +223,13 @@ class ModelsAttributes(ModelsAtrrsReflect):
         models_rels.clear()
         models_rels.update(new_mr)
 
-    def _build(self, dict_):
-        models_rels = {}
-        for model_name, model in dict_.iteritems():
-            rels = model.get('relationships', {})
-            models_rels[model_name] = self._build_relationships_dict(rels)
+    def _build(self, dict_, cache=False, cache_dir=None):
+        definition = self._get_definition(dict_, cache, cache_dir)
+        for model_name in definition:
             self._init_attrs(model_name)
-        self._check_rels(models_rels)
 
-        for model_name, model in dict_.iteritems():
-            self._build_columns(model_name, model)
-            self._build_relationships(model_name, models_rels[model_name])
+        for model_name, model in definition.iteritems():
+            self._build_columns(model_name, model['columns'])
+            self._build_relationships(model_name, model['relationships'])
+            self._build_indexes(model_name, model['indexes'])
             self[model_name]['__tablename__'] = model_name
@@ -16,9 +16,41 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import re
+import hashlib
 import logging
+from sqlalchemy import inspect
 from sqlalchemy.orm import relationship
-from alquimia.utils import log
+from alquimia.utils import log, load_pickle, dump_pickle
+from alquimia import __version__
+
+
+SCHEMA_CHECKSUM_QUERIES = {
+    'sqlite': [
+        'SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY name'
+    ],
+    'mysql': [
+        'SELECT table_name, column_name, column_type, is_nullable, '
+        'column_key FROM information_schema.columns WHERE table_schema = '
+        'DATABASE() ORDER BY table_name, ordinal_position',
+        'SELECT table_name, column_name, referenced_table_name, '
+        'referenced_column_name FROM information_schema.key_column_usage '
+        'WHERE table_schema = DATABASE() ORDER BY table_name, '
+        'constraint_name, ordinal_position'
+    ],
+    'postgresql': [
+        'SELECT table_name, column_name, data_type, is_nullable FROM '
+        'information_schema.columns WHERE table_schema = current_schema() '
+        'ORDER BY table_name, ordinal_position',
+        'SELECT table_name, constraint_name, constraint_type FROM '
+        'information_schema.table_constraints WHERE table_schema = '
+        'current_schema() ORDER BY table_name, constraint_name',
+        'SELECT table_name, column_name, constraint_name FROM '
+        'information_schema.key_column_usage WHERE table_schema = '
+        'current_schema() ORDER BY table_name, constraint_name, '
+        'ordinal_position'
+    ]
+}
 
 
 class OneToOneManyToManyError(Exception):
@@ -67,38 +99,67 @@ class ModelsAtrrsReflect(dict):
         if not rel_name == table_name:
             self._add_rel('oto', table_name, rel_name, args)
 
+    def _build_planned_rel(self, rel):
+        self._rels_plan.append(rel)
+        rel_type, rel_name, table_name, mtm_table = rel
+        if rel_type == 'mtm':
+            self._build_many_to_many_rel(rel_name, table_name, mtm_table)
+        elif rel_type == 'mto':
+            self._build_many_to_one_rel(rel_name, table_name)
+        else:
+            id_column = self._metadata.tables[table_name].c['id'] \
+                                          if rel_name == table_name else None
+            self._build_one_to_one_rel(rel_name, table_name, id_column)
+
     def _build_relationships(self, table):
         for fk in table.foreign_keys:
             rel_name = fk.column.table.name
-            id_column = table.c['id'] if rel_name == table.name else None
-            if id_column is not None or fk.parent.unique:
-                self._build_one_to_one_rel(rel_name, table.name, id_column)
+            if rel_name == table.name or fk.parent.unique:
+                rel_type = 'oto'
             else:
-                self._build_many_to_one_rel(rel_name, table.name)
-        mtm_tables = list(self._mtm_tables.values())
-        for mtm_table in mtm_tables:
-            mtm_rels = list(mtm_table.columns.keys())
-            table_rel = table.name+'_id'
-            if table_rel in mtm_rels:
-                mtm_rels.remove(table_rel)
-                rel_name = mtm_rels[0][:-3]
-                self._build_many_to_many_rel(rel_name, table.name,
-                                                                mtm_table.name)
-                self._mtm_tables.pop(mtm_table.name)
-
-    def _keep_mtm_tables(self):
-        self._mtm_tables = {}
-        for table in self._metadata.tables.values():
-            fks = table.foreign_keys
-            if len(fks) == len(table.c) == 2:
-                is_pks = True
-                for fk in fks:
-                    if not fk.column.primary_key:
-                        is_pks = False
-                        break
-                if not is_pks:
-                    continue
+                rel_type = 'mto'
+            self._build_planned_rel((rel_type, rel_name, table.name, None))
+        table_rel = table.name+'_id'
+        for mtm_table in self._mtm_index.pop(table_rel, []):
+            if self._mtm_tables.pop(mtm_table.name, None) is None:
+                continue
+            rel_name = [col_name for col_name in mtm_table.columns.keys() \
+                                           if col_name != table_rel][0][:-3]
+            self._build_planned_rel(('mtm', rel_name, table.name,
+                                                            mtm_table.name))
+
+    def _keep_mtm_tables(self, tables):
+        for table in tables:
+            if len(table.c) != 2 or len(table.foreign_keys) != 2:
+                continue
+            if all(fk.column.primary_key for fk in table.foreign_keys):
                 self._mtm_tables[table.name] = table
+                for col_name in table.columns.keys():
+                    self._mtm_index.setdefault(col_name, []).append(table)
+
+    def _is_association(self, table_name, selected):
+        if not table_name.endswith('_association'):
+            return False
+        prefix = table_name[:-len('_association')]
+        for name in selected:
+            if prefix.startswith(name+'_') or prefix.endswith('_'+name):
+                return True
+        return False
+
+    def _select_tables(self, only, pattern):
+        if only is None and pattern is None:
+            return None
+        tables_names = self._metadata.bind.table_names()
+        only = set(only or [])
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        selected = [name for name in tables_names if name in only or \
+                              (pattern is not None and pattern.match(name))]
+        if selected:
+            selected.extend([name for name in tables_names \
+                    if name not in selected and \
+                                    self._is_association(name, selected)])
+        return selected
 
     def _init_attrs(self, table_name):
         self[table_name] = {
@@ -111,16 +172,80 @@ class ModelsAtrrsReflect(dict):
             'session': None
         }
 
-    def _build(self, *args):
-        self._metadata.reflect()
-        self._keep_mtm_tables()
-        attrs = {}
-        tables = [table for table in self._metadata.tables.values() \
+    def reflect(self, only=None, pattern=None):
+        selected = self._select_tables(only, pattern)
+        if selected == []:
+            return []
+        known = set(self._metadata.tables.keys())
+        self._metadata.reflect(only=selected)
+        return self._build_tables([table for table in \
+          self._metadata.tables.values() if table.name not in known])
+
+    def _build_tables(self, new_tables):
+        self._keep_mtm_tables(new_tables)
+        tables = [table for table in new_tables \
                                          if table.name not in self._mtm_tables]
         for table in tables:
             self._init_attrs(str(table.name))
 
         for table in tables:
-            if table.name not in self._mtm_tables:
-                self._build_relationships(table)
-                self[table.name]['__table__'] = table
+            self._build_relationships(table)
+            self[table.name]['__table__'] = table
+        return [str(table.name) for table in tables]
+
+    def _schema_checksum(self):
+        bind = self._metadata.bind
+        checksum = hashlib.sha1()
+        queries = SCHEMA_CHECKSUM_QUERIES.get(bind.dialect.name)
+        if queries is None:
+            inspector = inspect(bind)
+            for table_name in sorted(inspector.get_table_names()):
+                columns = inspector.get_columns(table_name)
+                checksum.update(repr((table_name,
+                     [(c['name'], str(c['type'])) for c in columns])))
+        else:
+            for query in queries:
+                for row in bind.execute(query):
+                    checksum.update(repr(tuple(row)))
+        return checksum.hexdigest()
+
+    def _restore_snapshot(self, snapshot):
+        for table in snapshot['metadata'].sorted_tables:
+            table.tometadata(self._metadata)
+        for table_name in snapshot['tables']:
+            self._init_attrs(table_name)
+        for rel in snapshot['rels_plan']:
+            self._build_planned_rel(rel)
+        for table_name in snapshot['tables']:
+            self[table_name]['__table__'] = self._metadata.tables[table_name]
+
+    def _build_from_snapshot(self, only, pattern, path):
+        if pattern is not None and not isinstance(pattern, basestring):
+            pattern = pattern.pattern
+        key = {
+            'version': __version__,
+            'checksum': self._schema_checksum(),
+            'selection': (sorted(only) if only is not None else None, pattern)
+        }
+        snapshot = load_pickle(path, self._logger, 'reflection snapshot')
+        if snapshot is not None and snapshot['key'] == key:
+            self._restore_snapshot(snapshot)
+            return
+        tables = self.reflect(only, pattern)
+        dump_pickle(path, {
+            'key': key,
+            'metadata': self._metadata,
+            'tables': tables,
+            'rels_plan': self._rels_plan
+        })
+
+    def _build(self, only=None, pattern=None, lazy=False, snapshot=None):
+        self._mtm_tables = {}
+        self._mtm_index = {}
+        self._rels_plan = []
+        if lazy:
+            return
+        if snapshot is not None:
+            self._build_from_snapshot(only, pattern, snapshot)
+        else:
+            self.reflect(only, pattern)
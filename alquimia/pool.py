@@ -0,0 +1,140 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import threading
+from weakref import WeakKeyDictionary
+from sqlalchemy import exc, select
+from alquimia.utils import EventHub
+
+
+def ping_connection(connection, branch):
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError, e:
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+class PoolHub(EventHub):
+    hubs = WeakKeyDictionary()
+    events = ('connect', 'checkout', 'checkin')
+    # sessions check out through connect, Engine.connect() and
+    # raw_connection() through unique_connection
+    checkouts = ('connect', 'unique_connection')
+
+    def __init__(self, pool):
+        EventHub.__init__(self, pool)
+        pool.connect = self._timed_connect
+        pool.unique_connection = self._timed_unique_connection
+
+    def _remove(self, pool):
+        EventHub._remove(self, pool)
+        for name in self.checkouts:
+            delattr(pool, name)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self._dispatch('_count', 'connects')
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                                                         connection_proxy):
+        self._dispatch('_count', 'checkouts')
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self._dispatch('_count', 'checkins')
+
+    def _timed_connect(self):
+        return self._timed_checkout('connect')
+
+    def _timed_unique_connection(self):
+        return self._timed_checkout('unique_connection')
+
+    def _timed_checkout(self, name):
+        pool = self._target()
+        start = time.time()
+        timeout = False
+        try:
+            return getattr(type(pool), name)(pool)
+        except exc.TimeoutError:
+            timeout = True
+            raise
+        finally:
+            self._dispatch('_wait', time.time() - start, timeout)
+
+
+class PoolStats(object):
+    def __init__(self, engine):
+        self._pool = engine.pool
+        self._lock = threading.Lock()
+        self.reset()
+        self._hub = PoolHub.attach(self._pool, self)
+
+    def detach(self):
+        if self._hub is not None:
+            self._hub.detach(self)
+            self._hub = None
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.timeouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+            self._waits = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _wait(self, wait, timeout):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            self._waits += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def snapshot(self):
+        pool = self._pool
+        with self._lock:
+            stats = {
+                'pool': type(pool).__name__,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checked_out': self.checkouts - self.checkins,
+                'timeouts': self.timeouts,
+                'avg_wait': self.total_wait / self._waits \
+                                                      if self._waits else 0.0,
+                'max_wait': self.max_wait
+            }
+        for name in ('size', 'overflow', 'checkedout'):
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        if 'checkedout' in stats:
+            stats['checked_out'] = stats.pop('checkedout')
+        return stats
@@ -0,0 +1,104 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+
+SESSION_POLICIES = ('shared', 'per_operation', 'expunge_on_commit')
+
+
+class SessionLifecycle(object):
+    def __init__(self, session, policy='shared', max_identity_map=None):
+        if policy not in SESSION_POLICIES:
+            raise TypeError("'%s' is not a valid session policy!" % policy)
+        self._session = session
+        self._scoped = isinstance(session, scoped_session)
+        self.policy = policy
+        self.max_identity_map = max_identity_map
+        self._lock = threading.Lock()
+        self.reset()
+
+    def listen(self, session_class):
+        if self.policy == 'expunge_on_commit':
+            event.listen(session_class, 'after_commit', self._on_commit)
+
+    def reset(self):
+        with self._lock:
+            self.peak_identity_map = 0
+            self.expunged = 0
+            self.evictions = 0
+            self.sessions_closed = 0
+
+    def _observe(self, size):
+        with self._lock:
+            self.peak_identity_map = max(self.peak_identity_map, size)
+
+    def _on_commit(self, session):
+        size = len(session.identity_map)
+        self._observe(size)
+        session.expunge_all()
+        with self._lock:
+            self.expunged += size
+
+    def _evict(self):
+        session = self._session
+        identity_map = session.identity_map
+        pending = set(session.dirty) | set(session.deleted)
+        evictions = 0
+        for obj in list(identity_map.values()):
+            if len(identity_map) <= self.max_identity_map:
+                break
+            if obj in session and not obj in pending:
+                session.expunge(obj)
+                evictions += 1
+        with self._lock:
+            self.evictions += evictions
+
+    def after_operation(self):
+        session = self._session
+        if session.info.get('unit_of_work') or session.info.get('streams'):
+            return
+        size = len(session.identity_map)
+        self._observe(size)
+        if self.policy == 'per_operation':
+            if self._scoped:
+                session.remove()
+            else:
+                session.close()
+            with self._lock:
+                self.sessions_closed += 1
+                self.expunged += size
+        elif self.max_identity_map is not None and \
+                                                 size > self.max_identity_map:
+            self._evict()
+
+    def snapshot(self):
+        size = len(self._session.identity_map)
+        self._observe(size)
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'max_identity_map': self.max_identity_map,
+                'identity_map': size,
+                'peak_identity_map': self.peak_identity_map,
+                'expunged': self.expunged,
+                'evictions': self.evictions,
+                'sessions_closed': self.sessions_closed
+            }
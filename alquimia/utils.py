@@ -16,6 +16,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import tempfile
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from weakref import WeakSet, ref
+from sqlalchemy import event
+
+
 def log(logger, level, message):
     levels = {
         'info': logger.info,
@@ -25,3 +34,99 @@ def log(logger, level, message):
         'debug': logger.debug
     }
     levels[level]('alquimia:%s' % message)
+
+
+def load_pickle(path, logger, what):
+    try:
+        with open(path, 'rb') as file_:
+            return pickle.load(file_)
+    except (IOError, EOFError, pickle.UnpicklingError), error:
+        if os.path.exists(path):
+            log(logger, 'warning', 'Ignoring invalid %s %s: %s' %
+                                                        (what, path, error))
+
+
+def dump_pickle(path, obj):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'wb') as file_:
+        pickle.dump(obj, file_, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+
+def chunks(list_, size):
+    for i in xrange(0, len(list_), size):
+        yield list_[i:i+size]
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'size': len(self._items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class EventHub(object):
+    # listens once per target and dispatches to every subscriber; they are
+    # held weakly, so forgotten subscribers do not pile up listeners
+    hubs = None
+    events = ()
+
+    def __init__(self, target):
+        self._target = ref(target)
+        self.subscribers = WeakSet()
+        for name in self.events:
+            event.listen(target, name, getattr(self, '_on_' + name))
+
+    @classmethod
+    def attach(cls, target, subscriber):
+        hub = cls.hubs.get(target)
+        if hub is None:
+            hub = cls.hubs[target] = cls(target)
+        hub.subscribers.add(subscriber)
+        return hub
+
+    def detach(self, subscriber):
+        self.subscribers.discard(subscriber)
+        target = self._target()
+        if not self.subscribers and target is not None:
+            self._remove(target)
+            del self.hubs[target]
+
+    def _remove(self, target):
+        for name in self.events:
+            event.remove(target, name, getattr(self, '_on_' + name))
+
+    def _dispatch(self, method, *args):
+        for subscriber in list(self.subscribers):
+            getattr(subscriber, method)(*args)
@@ -0,0 +1,61 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+from alquimia import AlquimiaModels
+
+
+models_dict = {
+    'person': {
+        'name': 'string',
+        'age': 'integer',
+        'relationships': ['address', {'tag': 'many-to-many'}]
+    },
+    'address': {
+        'street': 'string'
+    },
+    'tag': {
+        'label': 'string'
+    }
+}
+
+
+def build_objs(n, nested):
+    objs = [{'name': 'person%d' % i, 'age': i % 100} for i in xrange(n)]
+    if nested:
+        for i, obj in enumerate(objs):
+            obj['address'] = {'street': 'street%d' % i}
+            obj['tag'] = [{'label': 'tag%d' % i}]
+    return objs
+
+
+def run(n, nested, method, **kwargs):
+    models = AlquimiaModels('sqlite://', models_dict, create=True)
+    objs = build_objs(n, nested)
+    start = time.time()
+    getattr(models['person'], method)(objs, **kwargs)
+    elapsed = time.time() - start
+    assert models['person'].query().count() == n
+    return elapsed
+
+
+METHODS = (
+    ('insert', 'insert', {}),
+    ('bulk_insert', 'bulk_insert', {}),
+    ('bulk_insert_no_ids', 'bulk_insert', {'return_ids': False})
+)
@@ -0,0 +1,63 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sys
+import time
+import logging
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey
+from alquimia.models_attrs_reflect import ModelsAtrrsReflect
+
+
+def build_metadata(n):
+    metadata = MetaData()
+    for i in xrange(n):
+        columns = [Column('id', Integer, primary_key=True),
+                   Column('name', String(255))]
+        if i:
+            columns.append(Column('t%d_id' % (i - 1), Integer,
+                                               ForeignKey('t%d.id' % (i - 1))))
+        Table('t%d' % i, metadata, *columns)
+        if i % 2:
+            Table('t%d_t%d_association' % (i, i - 1), metadata,
+                  Column('t%d_id' % (i - 1), Integer,
+                         ForeignKey('t%d.id' % (i - 1)), primary_key=True),
+                  Column('t%d_id' % i, Integer,
+                         ForeignKey('t%d.id' % i), primary_key=True))
+    return metadata
+
+
+def run(n):
+    metadata = build_metadata(n)
+    attrs = ModelsAtrrsReflect(metadata, logging, None, None, True)
+    tables = list(metadata.tables.values())
+    start = time.time()
+    attrs._build_tables(tables)
+    return time.time() - start
+
+
+def main(n=4000):
+    for size in (n / 4, n / 2, n):
+        elapsed = run(size)
+        print '%6d tables %8.3fs %10.1f us/table' % \
+                                     (size, elapsed, elapsed * 1e6 / size)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(*[int(arg) for arg in sys.argv[1:]])
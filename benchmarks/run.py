@@ -0,0 +1,220 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import json
+import time
+import logging
+import argparse
+import platform
+import sqlalchemy
+import alquimia
+from alquimia import AlquimiaModels
+import todict as todict_cases
+import bulk_insert as bulk_insert_cases
+
+
+def build_models_dict(tables, fanout):
+    models_dict = {}
+    for i in xrange(tables):
+        rels = ['t%d' % j for j in xrange(i + 1, min(i + 1 + fanout, tables))]
+        models_dict['t%d' % i] = {
+            'name': 'string',
+            'value': 'integer',
+            'body': 'text',
+            'relationships': rels
+        }
+    return models_dict
+
+
+def build_obj(i, level, depth, fanout, tables):
+    obj = {'name': 'obj%d' % i, 'value': i, 'body': 'body%d' % i}
+    if depth:
+        for j in xrange(level + 1, min(level + 1 + fanout, tables)):
+            obj['t%d' % j] = build_obj(i, j, depth - 1, fanout, tables)
+    return obj
+
+
+def timed(func, repeat):
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return summarize(times)
+
+
+def summarize(times):
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) / 2]}
+
+
+def result(times, ops, unit):
+    times['throughput'] = ops / times['median'] if times['median'] else None
+    times['unit'] = unit
+    return times
+
+
+def bench_startup(config, models_dict):
+    def startup():
+        AlquimiaModels('sqlite://', models_dict, create=True)
+    return result(timed(startup, config.repeat), config.tables, 'tables/s')
+
+
+def bench_bulk_insert(config, models):
+    objs = [build_obj(i, 0, config.depth, config.fanout, config.tables) \
+                                                   for i in xrange(config.rows)]
+    def bulk_insert():
+        models['t0'].bulk_insert(objs, return_ids=False)
+    return result(timed(bulk_insert, config.repeat), config.rows, 'objs/s')
+
+
+def bench_update(config, models):
+    ids = [obj['id'] for obj in models['t0'].stream(fields=['id'])]
+    ids = ids[:config.rows]
+    def nested_values():
+        values = []
+        for id_ in ids:
+            value = {'id': id_, 'value': id_ + 1}
+            if config.depth and config.tables > 1:
+                value['t1'] = {'name': 'updated%d' % id_}
+            values.append(value)
+        return values
+    def update():
+        models['t0'].update(nested_values())
+        models.clean()
+    return result(timed(update, config.repeat), len(ids), 'objs/s')
+
+
+def bench_query(config, models):
+    filters = [{'value': {'_gte': i % config.rows}, 'name': {'_prefix': 'obj'}}
+                                                    for i in xrange(config.queries)]
+    if config.tables > 1:
+        for i, filter_ in enumerate(filters):
+            filter_['t1'] = {'value': {'_lt': config.rows - i % config.rows}}
+    def query():
+        for filter_ in filters:
+            models['t0'].query(filter_).limit(10).all()
+        models.clean()
+    return result(timed(query, config.repeat), config.queries, 'queries/s')
+
+
+def bench_parse_filters(config, models):
+    filters = [{'value': i, 'name': {'_like': 'obj%d%%' % i},
+                '_or': [{'body': 'a'}, {'value': {'_in': [1, 2, 3]}}]}
+                                              for i in xrange(config.queries)]
+    def parse_filters():
+        models['t0']._filters_cache.clear()
+        for filter_ in filters:
+            models['t0']._compile_filters(filter_)
+    return result(timed(parse_filters, config.repeat), config.queries,
+                                                                'filters/s')
+
+
+def bench_todict(config, models):
+    objs = models['t0'].query(depth=config.depth).limit(config.rows).all()
+    def todict():
+        for obj in objs:
+            obj.todict(depth=config.depth)
+    count = len(objs)
+    times = result(timed(todict, config.repeat), count, 'objs/s')
+    models.clean()
+    return times
+
+
+def bench_todict_cases(config):
+    results = {}
+    for name, build in todict_cases.CASES:
+        obj = todict_cases.setup(config.rows, build)
+        results['todict_' + name] = \
+                    result(timed(obj.todict, config.repeat), config.rows, 'objs/s')
+    return results
+
+
+def bench_bulk_insert_cases(config):
+    results = {}
+    for nested in (False, True):
+        suffix = '_nested' if nested else '_flat'
+        for name, method, kwargs in bulk_insert_cases.METHODS:
+            times = [bulk_insert_cases.run(config.rows, nested, method, **kwargs) \
+                                                   for _ in xrange(config.repeat)]
+            results[name + suffix] = \
+                              result(summarize(times), config.rows, 'rows/s')
+    return results
+
+
+def run(config):
+    models_dict = build_models_dict(config.tables, config.fanout)
+    results = {'startup': bench_startup(config, models_dict)}
+    models = AlquimiaModels('sqlite://', models_dict, create=True)
+    results['bulk_insert'] = bench_bulk_insert(config, models)
+    results['update'] = bench_update(config, models)
+    results['query'] = bench_query(config, models)
+    results['parse_filters'] = bench_parse_filters(config, models)
+    results['todict'] = bench_todict(config, models)
+    results.update(bench_todict_cases(config))
+    results.update(bench_bulk_insert_cases(config))
+    return results
+
+
+def compare(results, baseline):
+    for name, times in sorted(results.iteritems()):
+        old = baseline.get(name)
+        ratio = ''
+        if old is not None and old['throughput'] and times['throughput']:
+            ratio = '%7.2fx' % (times['throughput'] / old['throughput'])
+        print '%-26s %9.4fs %12.1f %-10s %s' % (name, times['median'],
+                          times['throughput'] or 0, times['unit'], ratio)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                               description='Run the alquimia benchmark suite.')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    config = parser.parse_args(argv)
+
+    results = run(config)
+    baseline = {}
+    if config.compare:
+        with open(config.compare) as file_:
+            baseline = json.load(file_)['results']
+    compare(results, baseline)
+    if config.output:
+        with open(config.output, 'w') as file_:
+            json.dump({
+                'config': vars(config),
+                'environment': {
+                    'python': platform.python_version(),
+                    'sqlalchemy': sqlalchemy.__version__,
+                    'alquimia': alquimia.__version__,
+                    'time': time.time()
+                },
+                'results': results
+            }, file_, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,70 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from alquimia import AlquimiaModels
+
+
+models_dict = {
+    'person': {
+        'name': 'string',
+        'relationships': ['address', {'tag': 'many-to-many'}]
+    },
+    'address': {
+        'street': 'string'
+    },
+    'tag': {
+        'label': 'string'
+    },
+    'node': {
+        'value': 'integer',
+        'relationships': {'node': 'one-to-one'}
+    }
+}
+
+
+def build_wide(models, n):
+    tags = [{'label': 'tag%d' % i} for i in xrange(n / 10 or 1)]
+    tag_ids = models['tag'].bulk_insert(tags)
+    address_id = models['address'].bulk_insert({'street': 'street'})
+    models['person'].bulk_insert([{'name': 'person%d' % i,
+                                   'address_id': address_id} \
+                                  for i in xrange(n)], return_ids=False)
+    assoc = models.metadata.tables['person_tag_association']
+    persons = models['person'].stream(fields=['id'])
+    rows = [{'person_id': person['id'], 'tag_id': tag_ids[i % len(tag_ids)]} \
+                                          for i, person in enumerate(persons)]
+    models['person']._session.execute(assoc.insert(), rows)
+    models['person']._session.commit()
+    return models['address'].query().one()
+
+
+def build_deep(models, n):
+    ids = models['node'].bulk_insert([{'value': i} for i in xrange(n)])
+    models['node'].bulk_update([{'id': id_, 'node_id': prev_id} \
+                                         for prev_id, id_ in zip(ids, ids[1:])])
+    return models['node'].query({'id': ids[-1]}).one()
+
+
+CASES = (('wide', build_wide), ('deep', build_deep))
+
+
+def setup(n, build):
+    models = AlquimiaModels('sqlite://', models_dict, create=True)
+    obj = build(models, n)
+    obj.todict()
+    return obj
@@ -20,7 +20,8 @@ import os
 import pytest
 import copy
 from alquimia.models import AlquimiaModels
-from sqlalchemy import MetaData
+from alquimia.async_models import AlquimiaAsyncModels
+from sqlalchemy import MetaData, event
 
 
 @pytest.fixture(scope='class')
@@ -89,9 +90,9 @@ def db_uri():
 
 def models_finalizer(models_):
     s = models_._session
-    for model in models_.values():
-        s.query(model).delete()
-        s.commit()
+    for table in reversed(models_.metadata.sorted_tables):
+        s.execute(table.delete())
+    s.commit()
 
 @pytest.fixture(scope='class')
 def models_create(request, user_models, db_uri):
@@ -110,6 +111,65 @@ def models(request, user_models, models_create, db_uri):
     request.addfinalizer(fin)
     return models_
 
+@pytest.fixture
+def models_scoped(request, user_models, models_create, db_uri):
+    models_ = AlquimiaModels(db_uri, user_models, scoped=True)
+    def fin():
+        models_finalizer(models_)
+    request.addfinalizer(fin)
+    return models_
+
+@pytest.fixture
+def async_models(request, user_models, models_create, db_uri):
+    models_ = AlquimiaAsyncModels(db_uri, user_models)
+    def fin():
+        models_.close()
+        models_finalizer(models_.models)
+    request.addfinalizer(fin)
+    return models_
+
+@pytest.fixture(scope='class')
+def node_models(request, db_uri):
+    models_dict = {
+        'node': {
+            'value': 'integer',
+            'relationships': {'node': 'one-to-one'}
+        }
+    }
+    models_ = AlquimiaModels(db_uri, models_dict, create=True)
+    request.addfinalizer(models_.metadata.drop_all)
+    return models_
+
+@pytest.fixture
+def person_models(request, db_uri):
+    models_dict = {
+        'person': {
+            'email': {'type': 'string', 'unique': True},
+            'name': 'string',
+            'age': {'type': 'integer', 'default': 18},
+            'relationships': ['address'],
+            'indexes': [{'columns': ['name', 'age'], 'unique': True}]
+        },
+        'address': {
+            'street': 'string'
+        }
+    }
+    models_ = AlquimiaModels(db_uri, models_dict, create=True)
+    request.addfinalizer(models_.metadata.drop_all)
+    return models_
+
+@pytest.fixture
+def statements(request, models):
+    statements_ = []
+    engine = models.metadata.bind
+    def listener(conn, cursor, statement, *args):
+        statements_.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    def fin():
+        event.remove(engine, 'before_cursor_execute', listener)
+    request.addfinalizer(fin)
+    return statements_
+
 @pytest.fixture
 def models_reflect(request, models_create, db_uri):
     models_ = AlquimiaModels(db_uri)
@@ -130,9 +190,9 @@ def t1_t2_query():
 @pytest.fixture
 def t1_t2_query_like():
     return {
-        'c4': 'testa%',
+        'c4': {'_like': 'testa%'},
         't2': {
-            'c1': 'test%'
+            'c1': {'_like': 'test%'}
         }
     }
 
@@ -186,6 +246,19 @@ def t8_t7_t1_t2_obj(t1_simple_obj):
         }
     }
 
+@pytest.fixture
+def t8_t7_obj():
+    return {
+        'c8': 'test18',
+        't7': {
+            'c7': 'test17'
+        }
+    }
+
+@pytest.fixture
+def t2_t6_obj():
+    return {'c1': 'test12', 't6': [{}, {}]}
+
 @pytest.fixture
 def one_level_obj(t1_simple_obj):
     obj = t1_simple_obj.copy()
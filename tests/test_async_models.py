@@ -0,0 +1,62 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import copy
+import pytest
+
+
+class TestAlquimiaAsyncModels(object):
+    def test_async_insert(self, async_models, t8_t7_obj):
+        results = [async_models['t8'].insert(copy.deepcopy(t8_t7_obj)) \
+                                                            for i in range(8)]
+        objs = [result.get(10) for result in results]
+        assert len(set(obj['id'] for obj in objs)) == 8
+        assert objs[0]['t7']['c7'] == t8_t7_obj['t7']['c7']
+        assert len(async_models['t8'].query().get(10)) == 8
+
+    def test_async_query(self, async_models, t8_t7_obj):
+        async_models['t8'].bulk_insert([t8_t7_obj, {'c8': 'test28'}]).get(10)
+        objs = async_models['t8'].query({'c8': 'test18'}, include=['t7'])
+        objs = objs.get(10)
+        assert len(objs) == 1
+        assert objs[0]['t7']['c7'] == t8_t7_obj['t7']['c7']
+
+    def test_async_update_delete(self, async_models, t8_t7_obj):
+        id_ = async_models['t8'].bulk_insert(t8_t7_obj).get(10)
+        obj = async_models['t8'].update({'id': id_, 'c8': 'test28'}, depth=0)
+        assert obj.get(10) == {'id': id_, 'c8': 'test28'}
+        assert async_models['t8'].delete(id_).get(10) == 1
+        assert async_models['t8'].query().get(10) == []
+
+    def test_async_callback(self, async_models, t8_t7_obj):
+        results = []
+        async_models['t8'].bulk_insert(t8_t7_obj,
+                                       callback=results.append).wait(10)
+        assert len(results) == 1
+
+    def test_async_error(self, async_models):
+        with pytest.raises(TypeError):
+            async_models['t8'].delete('test').get(10)
+
+    def test_async_stream(self, async_models, t8_t7_obj):
+        async_models['t8'].bulk_insert([t8_t7_obj] * 5).get(10)
+        rows = list(async_models['t8'].stream(batch_size=2))
+        assert len(rows) == 5
+        stream = async_models['t8'].stream(batch_size=2)
+        assert next(stream)['c8'] == t8_t7_obj['c8']
+        stream.close()
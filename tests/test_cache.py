@@ -0,0 +1,80 @@
+# Copyright 2015 Diogo Dutra
+
+# This file is part of alquimia.
+
+# alquimia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+from alquimia.cache import MemoryCache, SharedCache
+
+
+class TestMemoryCache(object):
+    def test_cache_lru(self):
+        cache = MemoryCache(max_size=2)
+        cache.set('a', {'id': 1})
+        cache.set('b', {'id': 2})
+        assert cache.get('a') == {'id': 1}
+        cache.set('c', {'id': 3})
+        assert cache.get('b') is None
+        assert cache.get('a') == {'id': 1}
+        assert cache.stats()['evictions'] == 1
+
+    def test_cache_copies_values(self):
+        cache = MemoryCache()
+        value = {'id': 1, 'list': []}
+        cache.set('a', value)
+        value['list'].append(1)
+        cache.get('a')['list'].append(2)
+        assert cache.get('a') == {'id': 1, 'list': []}
+
+    def test_cache_ttl(self):
+        cache = MemoryCache(ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=0.01)
+        time.sleep(0.02)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+
+    def test_cache_max_bytes(self):
+        cache = MemoryCache(max_bytes=1000)
+        cache.set('a', 'a' * 600)
+        cache.set('b', 'b' * 600)
+        assert cache.get('a') is None
+        assert cache.get('b') == 'b' * 600
+        cache.set('c', 'c' * 2000)
+        assert cache.get('c') is None
+        assert cache.stats()['bytes'] <= 1000
+
+    def test_cache_counters(self):
+        cache = MemoryCache(max_size=1)
+        assert cache.get_counters(['a', 'b']) == [0, 0]
+        cache.incr('a')
+        cache.set('x', 1)
+        cache.set('y', 2)
+        assert cache.get_counters(['a', 'b']) == [1, 0]
+
+
+class TestSharedCache(object):
+    def test_shared_cache_namespace(self):
+        cache = SharedCache('test_namespace')
+        cache.clear()
+        cache.set('a', {'id': 1})
+        cache.incr('counter')
+        other = SharedCache('test_namespace')
+        assert other.get('a') == {'id': 1}
+        assert other.get_counters(['counter']) == [1]
+        assert SharedCache('other_namespace').get('a') is None
+        other.delete('a')
+        assert cache.get('a') is None
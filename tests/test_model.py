@@ -68,4 +68,29 @@ class TestAlquimiaModel(object):
         obj_exp = "{'c1': 'test', 'id': %dL, 't1': " \
             "[{'c2': 1L, 'c9': 'test', 'c4': 'test1', 'c1': True, 'id': %dL}]}" % \
             (obj['id'], obj['t1'][0]['id'])
-        assert repr(obj) == obj_exp
\ No newline at end of file
+        assert repr(obj) == obj_exp
+
+    def test_model_todict_depth(self, models, t8_t7_obj):
+        t8 = models['t8'].insert(t8_t7_obj)
+        assert t8.todict(depth=0) == {'id': t8['id'], 'c8': t8_t7_obj['c8']}
+        assert t8.todict(depth=1)['t7'] == \
+                         {'id': t8['t7']['id'], 'c7': t8_t7_obj['t7']['c7']}
+
+    def test_model_todict_fields(self, models, t8_t7_obj):
+        t8 = models['t8'].insert(t8_t7_obj)
+        assert t8.todict(fields=['c8']) == {'c8': t8_t7_obj['c8']}
+        assert t8.todict(fields=['id', 't7']) == {'id': t8['id'],
+                         't7': {'id': t8['t7']['id'], 'c7': t8_t7_obj['t7']['c7']}}
+        assert t8.todict(fields=['t7.c7']) == \
+                                        {'t7': {'c7': t8_t7_obj['t7']['c7']}}
+
+    def test_model_todict_deep(self, node_models):
+        model = node_models['node']
+        ids = model.bulk_insert([{'value': i} for i in range(2000)])
+        model.bulk_update([{'id': id_, 'node_id': prev_id} \
+                                        for prev_id, id_ in zip(ids, ids[1:])])
+        dict_ = model.query({'id': ids[-1]}).one().todict()
+        for i in reversed(range(2000)):
+            assert dict_['value'] == i
+            dict_ = dict_.get('node')
+        assert dict_ is None
@@ -18,6 +18,9 @@
 
 import pytest
 import copy
+import sqlalchemy
+from weakref import WeakKeyDictionary
+from alquimia import AlquimiaModels, modelmeta
 
 class TestAlquimiaModelMeta(object):
     def test_modelmeta_insert(self, models, t1_t2_obj):
@@ -168,14 +171,14 @@ class TestAlquimiaModelMeta(object):
         t1_t3_obj2['c1'] = False
         t1_t3_obj2['t3'][0]['c1'] = 'test13'
         models['t1'].insert(t1_t3_obj2)
-        q = models['t1'].query({'t1': {'c1': True, 't3': [{'c1': 'test13'}]}}).one()
+        q = models['t1'].query({'c1': True, 't3': [{'c1': 'test13'}]}).one()
         assert q['c1'] == True
         assert q['t3'][0]['c1'] == 'test13'
 
     def test_modelmeta_query_mtm_2_t3(self, models, t1_t3_obj):
         t1_t3_obj['t3'].append({'c1': 'test132'})
         models['t1'].insert(t1_t3_obj)
-        q = models['t1'].query({'t1': {'t3': [{'c1': 'test13'}, {'c1': 'test132'}]}}).one()
+        q = models['t1'].query({'t3': [{'c1': 'test13'}, {'c1': 'test132'}]}).one()
         assert q['c1'] == True
         assert q['t3'][0]['c1'] == 'test13'
         assert q['t3'][1]['c1'] == 'test132'
@@ -186,7 +189,7 @@ class TestAlquimiaModelMeta(object):
         t1_t3_obj2['c1'] = False
         t1_t3_obj2['t3'][0]['c1'] = 'test13'
         models['t1'].insert(t1_t3_obj2)
-        q = models['t1'].query({'t1': {'t3': [{'c1': 'test13'}]}}).all()
+        q = models['t1'].query({'t3': [{'c1': 'test13'}]}).all()
         assert q[0]['c1'] == True
         assert q[0]['t3'][0]['c1'] == 'test13'
         assert q[1]['c1'] == False
@@ -202,3 +205,430 @@ class TestAlquimiaModelMeta(object):
     def test_modelmeta_or_query(self, models, t1_t2_obj, t1_t2_query_or):
         models['t1'].insert(t1_t2_obj)
         assert models['t1'].query().all() == models['t1'].query(t1_t2_query_or).all()
+
+    def test_modelmeta_bulk_insert(self, models, t8_t7_obj):
+        ids = models['t8'].bulk_insert([t8_t7_obj, {'c8': 'test28'}])
+        assert len(ids) == 2
+        t8 = models['t8'].query({'c8': 'test18'}).one()
+        assert t8['id'] == ids[0]
+        assert t8['t7']['c7'] == t8_t7_obj['t7']['c7']
+        assert models['t8'].query({'c8': 'test28'}).one()['id'] == ids[1]
+
+    def test_modelmeta_bulk_insert_chunk_ids(self, models, t8_t7_obj,
+                                                             statements):
+        objs = [copy.deepcopy(t8_t7_obj) for i in range(10)]
+        for i, obj in enumerate(objs):
+            obj['c8'] = 'chunk%d' % i
+        del statements[:]
+        ids = models['t8'].bulk_insert(objs, 4)
+        inserts = [s for s in statements if s.startswith('INSERT')]
+        assert len(inserts) == 6
+        for i, id_ in enumerate(ids):
+            t8 = models['t8'].query({'id': id_}).one()
+            assert t8['c8'] == 'chunk%d' % i
+            assert t8['t7']['c7'] == t8_t7_obj['t7']['c7']
+
+    def test_modelmeta_bulk_insert_no_multivalues(self, models, t8_t7_obj,
+                                                      statements, monkeypatch):
+        dialect = models.metadata.bind.dialect
+        monkeypatch.setattr(dialect, 'supports_multivalues_insert', False)
+        monkeypatch.setattr(modelmeta, 'IDS_STRATEGIES', WeakKeyDictionary())
+        del statements[:]
+        ids = models['t8'].bulk_insert([copy.deepcopy(t8_t7_obj)] * 3)
+        inserts = [s for s in statements if s.startswith('INSERT')]
+        assert len(inserts) == 6
+        assert [models['t8'].query({'id': id_}).one()['c8'] \
+                                            for id_ in ids] == ['test18'] * 3
+
+    def test_modelmeta_bulk_insert_mtm(self, models, t2_t6_obj):
+        id_ = models['t2'].bulk_insert(t2_t6_obj)
+        t2 = models['t2'].query().one()
+        assert t2['id'] == id_
+        assert len(t2['t6']) == len(t2_t6_obj['t6'])
+
+    def test_modelmeta_bulk_insert_no_ids(self, models, t8_t7_obj):
+        assert models['t8'].bulk_insert([t8_t7_obj] * 3, 2, False) is None
+        assert models['t8'].query().count() == 3
+        assert models['t7'].query().count() == 3
+
+    def test_modelmeta_bulk_insert_invalid(self, models, invalid_obj):
+        with pytest.raises(TypeError):
+            models['t1'].bulk_insert(invalid_obj)
+
+    def test_modelmeta_update_batch(self, models, t8_t7_obj):
+        t8s = models['t8'].insert([copy.deepcopy(t8_t7_obj) for i in range(3)])
+        values = [{'id': t8['id'], 'c8': 'test%d' % i,
+                   't7': {'c7': 'test7%d' % i}} for i, t8 in enumerate(t8s)]
+        updated = models['t8'].update(values)
+        for i, t8 in enumerate(updated):
+            assert t8['c8'] == 'test%d' % i
+            assert t8['t7']['c7'] == 'test7%d' % i
+
+    def test_modelmeta_update_batch_otm(self, models, t8_t7_obj):
+        t7 = models['t7'].insert({'c7': 'test17', 't8': [{'c8': 'test18'}]})
+        updated = models['t7'].update({'id': t7['id'], 't8': [
+            {'id': t7['t8'][0]['id'], 'c8': 'test18 updated'},
+            {'c8': 'test28'}]})
+        assert [t8['c8'] for t8 in updated['t8']] == \
+                                                ['test18 updated', 'test28']
+
+    def test_modelmeta_update_batch_selects(self, models, statements):
+        t7s = models['t7'].insert([{'c7': 'test%d' % i,
+            't8': [{'c8': 'test%d1' % i}, {'c8': 'test%d2' % i}]} \
+                                                       for i in range(50)])
+        values = [{'id': t7['id'], 't8': [{'id': t8['id'], 'c8': 'updated'} \
+                                     for t8 in t7['t8']]} for t7 in t7s]
+        models.clean()
+        del statements[:]
+        models['t7'].update(values)
+        selects = [s for s in statements if s.startswith('SELECT')]
+        assert len(selects) == 3
+        t8s = [t8 for t7 in t7s for t8 in t7['t8']]
+        values = [{'id': t8['id'], 't7': {'c7': 'updated'}} for t8 in t8s]
+        models.clean()
+        del statements[:]
+        updated = models['t8'].update(values)
+        selects = [s for s in statements if s.startswith('SELECT')]
+        assert len(selects) == 1
+        assert set(t8['t7']['c7'] for t8 in updated) == set(['updated'])
+
+    def test_modelmeta_update_batch_string_ids(self, models):
+        t7 = models['t7'].insert({'c7': 'test17', 't8': [{'c8': 'test18'}]})
+        updated = models['t7'].update({'id': str(t7['id']), 't8': [
+            {'id': str(t7['t8'][0]['id']), 'c8': 'test18 updated'}]})
+        assert updated['id'] == t7['id']
+        assert updated['t8'][0]['c8'] == 'test18 updated'
+
+    def test_modelmeta_update_batch_invalid_nested_id(self, models):
+        t7 = models['t7'].insert({'c7': 'test17'})
+        with pytest.raises(TypeError):
+            models['t7'].update({'id': t7['id'], 't8': [{'id': -1}]})
+
+    def test_modelmeta_bulk_update(self, models, t8_t7_obj):
+        ids = models['t8'].bulk_insert([t8_t7_obj, t8_t7_obj])
+        models['t8'].bulk_update([{'id': id_, 'c8': 'test%d' % id_} \
+                                                               for id_ in ids])
+        for id_ in ids:
+            assert models['t8'].query({'id': id_}).one()['c8'] == \
+                                                                 'test%d' % id_
+
+    def test_modelmeta_bulk_update_rel(self, models, t8_t7_obj):
+        id_ = models['t8'].bulk_insert(t8_t7_obj)
+        with pytest.raises(TypeError):
+            models['t8'].bulk_update({'id': id_, 't7': {'c7': 'test'}})
+
+    def test_modelmeta_delete_count(self, models, t8_t7_obj):
+        ids = models['t8'].bulk_insert([t8_t7_obj] * 3)
+        assert models['t8'].delete(ids[:2] + [-1], chunk_size=1) == 2
+        assert models['t8'].query().one()['id'] == ids[2]
+
+    def test_modelmeta_delete_where(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj, {'c8': 'test28'}])
+        assert models['t8'].delete_where({'c8': 'test18'}) == 1
+        assert models['t8'].query().one()['c8'] == 'test28'
+        assert models['t8'].delete_where({'c8': 'test18'}) == 0
+
+    def test_modelmeta_stream(self, models, t8_t7_obj):
+        ids = models['t8'].bulk_insert([t8_t7_obj] * 3)
+        rows = list(models['t8'].stream({'c8': 'test18'}, batch_size=2))
+        rows.sort(key=lambda row: row['id'])
+        assert rows == [{'id': id_, 'c8': 'test18'} for id_ in ids]
+
+    def test_modelmeta_stream_fields(self, models, t8_t7_obj):
+        models['t8'].bulk_insert(t8_t7_obj)
+        rows = list(models['t8'].stream(fields=['c8']))
+        assert rows == [{'c8': 'test18'}]
+
+    def test_modelmeta_stream_invalid_field(self, models):
+        with pytest.raises(TypeError):
+            models['t8'].stream(fields=['t7'])
+
+    def test_modelmeta_query_depth(self, models, t2_t6_obj, statements):
+        models['t2'].bulk_insert([t2_t6_obj] * 3)
+        models.clean()
+        del statements[:]
+        objs = [t2.todict(depth=1) for t2 in models['t2'].query(depth=1)]
+        assert len(objs) == 3
+        assert len(objs[0]['t6']) == 2
+        assert len(statements) == 3
+
+    def test_modelmeta_query_include(self, models, t8_t7_obj, statements):
+        models['t8'].bulk_insert([t8_t7_obj] * 3)
+        models.clean()
+        del statements[:]
+        objs = [t8.todict(include=['t7']) for t8 in
+                                        models['t8'].query(include=['t7'])]
+        assert objs[0]['t7']['c7'] == t8_t7_obj['t7']['c7']
+        assert not 't8' in objs[0]['t7']
+        assert len(statements) == 1
+
+    def test_modelmeta_query_include_invalid(self, models):
+        with pytest.raises(TypeError):
+            models['t8'].query(include=['c8'])
+
+    def test_modelmeta_query_fields(self, models, t8_t7_obj, statements):
+        models['t8'].bulk_insert([t8_t7_obj] * 3)
+        models.clean()
+        del statements[:]
+        fields = ['c8', 't7.c7']
+        objs = [t8.todict(fields=fields) for t8 in
+                                        models['t8'].query(fields=fields)]
+        assert objs == [{'c8': 'test18', 't7': {'c7': 'test17'}}] * 3
+        assert len(statements) == 1
+        assert not 'c1' in statements[0]
+        assert not 't7.id = t8' in statements[0]
+
+    def test_modelmeta_query_fields_collection(self, models, t2_t6_obj,
+                                                                  statements):
+        models['t2'].insert(t2_t6_obj)
+        models.clean()
+        del statements[:]
+        obj = models['t2'].query(fields=['t6.id']).one()
+        assert obj.todict(fields=['t6.id']) == \
+                                 {'t6': [{'id': t6['id']} for t6 in obj['t6']]}
+        assert len(statements) == 2
+        assert statements[0].count(',') == 0
+
+    def test_modelmeta_query_fields_invalid(self, models):
+        with pytest.raises(TypeError):
+            models['t8'].query(fields=['invalid'])
+        with pytest.raises(TypeError):
+            models['t8'].query(fields=['c8.c7'])
+
+    def test_modelmeta_query_filters_cache(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj, {'c8': 'test28'}])
+        cache = models['t8']._filters_cache
+        assert models['t8'].query({'c8': 'test18'}).one()['c8'] == 'test18'
+        assert models['t8'].query({'c8': 'test28'}).one()['c8'] == 'test28'
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert models['t8'].query({'c8': None}).all() == []
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_modelmeta_query_filters_cache_or(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj, {'c8': 'test28'}])
+        query = {'_or': [{'c8': 'test18'}, {'c8': 'test28'}]}
+        assert models['t8'].query(query).count() == 2
+        query = {'_or': [{'c8': 'test28'}, {'c8': 'test38'}]}
+        assert models['t8'].query(query).one()['c8'] == 'test28'
+        assert models['t8']._filters_cache.hits == 1
+
+    def test_modelmeta_query_join(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj,
+                                  {'c8': 'test28', 't7': {'c7': 'test27'}}])
+        query = models['t8'].query({'t7': {'c7': 'test17'}})
+        assert 'JOIN' in str(query)
+        assert query.one()['c8'] == 'test18'
+
+    def test_modelmeta_query_join_dedup(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj,
+                                  {'c8': 'test28', 't7': {'c7': 'test27'}},
+                                  {'c8': 'test38'}])
+        query = models['t8'].query({'_or': [{'t7': {'c7': 'test17'}},
+                                            {'t7': {'c7': 'test27'}},
+                                            {'c8': 'test38'}]})
+        assert str(query).count('JOIN') == 1
+        assert query.count() == 3
+
+    def test_modelmeta_query_exists(self, models):
+        models['t7'].bulk_insert([
+            {'c7': 'test17', 't8': [{'c8': 'test18'}, {'c8': 'test28'}]},
+            {'c7': 'test27', 't8': [{'c8': 'test38'}]}])
+        query = models['t7'].query({'t8': [{'c8': 'test18'}, {'c8': 'test28'}]})
+        assert 'EXISTS' in str(query)
+        assert query.one()['c7'] == 'test17'
+
+    def test_modelmeta_query_exists_mtm(self, models, t2_t6_obj):
+        models['t2'].bulk_insert([t2_t6_obj, {'c1': 'test22', 't6': [{}]}])
+        assert models['t6'].query({'t2': {'c1': 'test12'}}).count() == 2
+        assert models['t2'].query({'t6': {}}).count() == 2
+
+    def test_modelmeta_query_instance(self, models):
+        t7s = models['t7'].insert([
+            {'c7': 'test17', 't8': [{'c8': 'test18'}, {'c8': 'test28'}]},
+            {'c7': 'test27', 't8': [{'c8': 'test38'}]}])
+        t8s = models['t8'].query({'t7': t7s[0]}).all()
+        assert sorted(t8['c8'] for t8 in t8s) == ['test18', 'test28']
+        assert models['t8'].query({'t7': t7s[1]}).one()['c8'] == 'test38'
+        assert models['t7'].query({'t8': t7s[1]['t8'][0]}).one() == t7s[1]
+        assert models['t8']._filters_cache.hits == 1
+        with pytest.raises(TypeError):
+            models['t8'].query({'t7': models['t7'](c7='test37')})
+
+    def test_modelmeta_query_or_and(self, models, t8_t7_obj):
+        models['t8'].bulk_insert([t8_t7_obj,
+                                  {'c8': 'test28', 't7': {'c7': 'test27'}}])
+        query = {'_or': [{'c8': 'test18', 't7': {'c7': 'test27'}},
+                         {'c8': 'test28', 't7': {'c7': 'test27'}}]}
+        assert models['t8'].query(query).one()['c8'] == 'test28'
+
+    def test_modelmeta_query_operators(self, models):
+        models['t7'].bulk_insert([{'c7': 'test%d' % i} for i in range(5)])
+        ids = [t7['id'] for t7 in models['t7'].stream()]
+        ids.sort()
+        model = models['t7']
+        assert model.query({'id': {'_gt': ids[3]}}).count() == 1
+        assert model.query({'id': {'_gte': ids[3]}}).count() == 2
+        assert model.query({'id': {'_lt': ids[1]}}).count() == 1
+        assert model.query({'id': {'_lte': ids[1]}}).count() == 2
+        assert model.query({'id': {'_gt': ids[0], '_lt': ids[2]}}).count() == 1
+        assert model.query({'id': {'_in': ids[:3]}}).count() == 3
+        assert model.query({'id': {'_in': []}}).count() == 0
+        assert model.query({'id': {'_between': ids[1:3]}}).count() == 2
+        assert model.query({'c7': {'_like': 'test_'}}).count() == 5
+        assert model.query({'c7': {'_prefix': 'test'}}).count() == 5
+        assert model.query({'c7': {'_is_null': True}}).count() == 0
+        assert model.query({'c7': {'_is_null': False}}).count() == 5
+        assert model.query({'t1_id': {'_is_null': True}}).count() == 5
+
+    def test_modelmeta_query_prefix_escape(self, models):
+        models['t7'].bulk_insert([{'c7': 'te%t_1'}, {'c7': 'test_1'}])
+        assert models['t7'].query({'c7': {'_prefix': 'te%'}}).one()['c7'] == \
+                                                                      'te%t_1'
+        assert models['t7'].query({'c7': {'_prefix': 'test_'}}).count() == 1
+
+    def test_modelmeta_query_str_equality(self, models):
+        models['t7'].bulk_insert([{'c7': 'test%'}, {'c7': 'test1'}])
+        assert models['t7'].query({'c7': 'test%'}).one()['c7'] == 'test%'
+
+    def test_modelmeta_query_between_invalid(self, models):
+        with pytest.raises(TypeError):
+            models['t7'].query({'id': {'_between': [1]}})
+
+    def test_modelmeta_paginate(self, models):
+        models['t7'].bulk_insert([{'c7': 'test%d' % (i % 3)} for i in range(7)])
+        rows = []
+        cursor = None
+        for i in range(4):
+            page, cursor = models['t7'].paginate(order_by=['-c7'],
+                                                 page_size=2, after=cursor)
+            rows += page
+            if cursor is None:
+                break
+        assert i == 3
+        assert len(rows) == 7
+        assert len(set(row['id'] for row in rows)) == 7
+        assert [row['c7'] for row in rows] == \
+                            sorted([row['c7'] for row in rows], reverse=True)
+        assert models['t7'].paginate(page_size=7)[1] is None
+
+    def test_modelmeta_paginate_filters(self, models):
+        models['t7'].bulk_insert([{'c7': 'test%d' % (i % 2)} for i in range(6)])
+        page, cursor = models['t7'].paginate({'c7': 'test1'}, page_size=2,
+                                             fields=['c7'])
+        assert page == [{'c7': 'test1'}, {'c7': 'test1'}]
+        page, cursor = models['t7'].paginate({'c7': 'test1'}, page_size=2,
+                                             after=cursor, fields=['c7'])
+        assert page == [{'c7': 'test1'}]
+        assert cursor is None
+
+    def test_modelmeta_paginate_invalid_cursor(self, models):
+        with pytest.raises(TypeError):
+            models['t7'].paginate(after='invalid')
+
+    def test_modelmeta_upsert(self, person_models, monkeypatch):
+        person = person_models['person']
+        monkeypatch.setattr(type(person), '_upsert_objs', None)
+        ids = person.upsert([{'email': 'a', 'name': 'A'},
+                             {'email': 'b', 'name': 'B', 'age': 30}], 'email')
+        assert person.upsert([{'email': 'b', 'name': 'B2'},
+                              {'email': 'c', 'name': 'C'}], 'email') == \
+                                                            [ids[1], ids[1] + 1]
+        person_models.clean()
+        people = sorted([p.todict() for p in person.query()],
+                        key=lambda p: p['id'])
+        assert people == [
+            {'id': ids[0], 'email': 'a', 'name': 'A', 'age': 18},
+            {'id': ids[1], 'email': 'b', 'name': 'B2', 'age': 30},
+            {'id': ids[1] + 1, 'email': 'c', 'name': 'C', 'age': 18}
+        ]
+
+    def test_modelmeta_upsert_composite_key(self, person_models):
+        person = person_models['person']
+        id_ = person.upsert({'name': 'A', 'age': 20, 'email': 'a'},
+                            ['name', 'age'])
+        assert person.upsert({'name': 'A', 'age': 20, 'email': 'b'},
+                             ['name', 'age']) == id_
+        assert person.query().one()['email'] == 'b'
+
+    def test_modelmeta_upsert_nested(self, person_models):
+        person = person_models['person']
+        id_ = person.upsert({'email': 'a', 'name': 'A'}, 'email')
+        ids = person.upsert([{'email': 'a', 'address': {'street': 's1'}},
+                             {'email': 'b', 'address': {'street': 's2'}},
+                             {'email': 'b', 'name': 'B'}], 'email')
+        assert ids == [id_, id_ + 1, id_ + 1]
+        person_models.clean()
+        people = sorted([p.todict() for p in person.query()],
+                        key=lambda p: p['id'])
+        assert [(p['email'], p['name'], p['address']['street']) \
+                   for p in people] == [('a', 'A', 's1'), ('b', 'B', 's2')]
+
+    def test_modelmeta_upsert_not_unique_key(self, person_models):
+        person = person_models['person']
+        id_ = person.upsert({'email': 'a', 'name': 'A'}, 'name')
+        assert person.upsert({'email': 'b', 'name': 'A'}, 'name') == id_
+        assert person.query().one()['email'] == 'b'
+
+    def test_modelmeta_upsert_collation(self, monkeypatch):
+        engine = sqlalchemy.create_engine('sqlite://')
+        engine.execute('CREATE TABLE person (id INTEGER PRIMARY KEY, '
+                       'email VARCHAR COLLATE NOCASE UNIQUE, name VARCHAR)')
+        person = AlquimiaModels(engine)['person']
+        id_ = person.upsert({'email': 'a@b.c', 'name': 'A'}, 'email')
+        assert person.upsert([{'email': 'A@B.C', 'name': 'A2'},
+                              {'email': 'a@B.c', 'name': 'A3'}],
+                             'email') == [id_, id_]
+        monkeypatch.setattr(type(person), '_native_upsert',
+                                                         lambda *args: False)
+        assert person.upsert({'email': 'A@b.C', 'name': 'A4'}, 'email') == id_
+        assert person.query().one()['name'] == 'A4'
+
+    def test_modelmeta_upsert_mysql_unique_keys(self, person_models,
+                                                                monkeypatch):
+        person = person_models['person']
+        monkeypatch.setattr(person.metadata.bind.dialect, 'name', 'mysql')
+        assert not person._native_upsert(['email'], [{'email': 'a'}])
+        address = person_models['address']
+        assert address._native_upsert(['id'], [{'id': 1, 'street': 's'}])
+
+    def test_modelmeta_upsert_error(self, person_models):
+        person = person_models['person']
+        with pytest.raises(TypeError):
+            person.upsert({'email': 'a'}, 'invalid')
+        with pytest.raises(KeyError):
+            person.upsert({'name': 'A'}, 'email')
+
+    def test_modelmeta_count(self, models, t8_t7_obj, t2_t6_obj):
+        models['t8'].bulk_insert([t8_t7_obj, t8_t7_obj, {'c8': 'test28'}])
+        models['t2'].insert(t2_t6_obj)
+        assert models['t8'].count() == 3
+        assert models['t8'].count({'c8': 'test18'}) == 2
+        assert models['t8'].count({'t7': {'c7': 'test17'}}) == 2
+        assert models['t2'].count({'t6': {'id': {'_gt': 0}}}) == 1
+
+    def test_modelmeta_exists(self, models, t8_t7_obj):
+        assert not models['t8'].exists()
+        models['t8'].insert(t8_t7_obj)
+        assert models['t8'].exists({'t7': {'c7': 'test17'}})
+        assert not models['t8'].exists({'c8': 'test28'})
+
+    def test_modelmeta_aggregate(self, person_models):
+        person = person_models['person']
+        person.bulk_insert([
+            {'email': 'a', 'name': 'A', 'age': 10, 'address': {'street': 's'}},
+            {'email': 'b', 'name': 'A', 'age': 20},
+            {'email': 'c', 'name': 'B', 'age': 30}])
+        assert person.aggregate() == {'count': 3}
+        assert person.aggregate(group_by=['name'],
+                                metrics={'age': ['min', 'max'], 'id': 'count'}) == [
+            {'name': 'A', 'age_min': 10, 'age_max': 20, 'id_count': 2},
+            {'name': 'B', 'age_min': 30, 'age_max': 30, 'id_count': 1}]
+        assert person.aggregate({'address': {'street': 's'}},
+                                metrics={'age': 'sum'}) == {'age_sum': 10}
+
+    def test_modelmeta_aggregate_invalid(self, person_models):
+        person = person_models['person']
+        with pytest.raises(TypeError):
+            person.aggregate(group_by=['address'])
+        with pytest.raises(TypeError):
+            person.aggregate(metrics={'age': 'median'})
@@ -17,11 +17,18 @@
 
 
 import pytest
+import copy
+import threading
 import sqlalchemy
 from tests.models_expected import models_expected, rels_expected
 from alquimia import AlquimiaModels
-from alquimia.models_attrs import AmbiguousRelationshipsError
+from alquimia import models_attrs
+from alquimia.cache import MemoryCache, SharedCache
+from alquimia.models_attrs import AmbiguousRelationshipsError, \
+                                                          ModelsAttributes
 from alquimia.models_attrs_reflect import OneToOneManyToManyError
+from alquimia.pool import PoolStats
+from alquimia.instrumentation import OperationStats
 from jsonschema import ValidationError
 
 
@@ -157,3 +164,463 @@ class TestAlquimiaModels(object):
     def test_models_invalid_attribute_error(self, user_models_invalid_attribute_error, db_uri):
         with pytest.raises(ValidationError):
             AlquimiaModels(db_uri, user_models_invalid_attribute_error)
+
+    def test_models_scoped(self, models_scoped, t8_t7_obj):
+        sessions = []
+        def insert():
+            models_scoped['t8'].insert(copy.deepcopy(t8_t7_obj))
+            sessions.append(models_scoped['t8']._session())
+        threads = [threading.Thread(target=insert) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(sessions)) == 4
+        assert models_scoped['t8'].query().count() == 4
+
+    def test_models_unit_of_work(self, models_scoped, t8_t7_obj):
+        with models_scoped.unit_of_work():
+            models_scoped['t8'].insert(t8_t7_obj)
+            models_scoped['t7'].insert({'c7': 'test27'})
+        assert models_scoped['t8'].query().count() == 1
+        assert models_scoped['t7'].query().count() == 2
+
+    def test_models_unit_of_work_rollback(self, models, t8_t7_obj):
+        with pytest.raises(TypeError):
+            with models.unit_of_work():
+                models['t8'].insert(t8_t7_obj)
+                models['t8'].delete('test')
+        assert models['t8'].query().count() == 0
+        assert models['t7'].query().count() == 0
+
+    def test_models_engine(self, models_create, user_models, db_uri):
+        engine = sqlalchemy.create_engine(db_uri)
+        models = AlquimiaModels(engine, user_models)
+        assert models.metadata.bind is engine
+        assert models['t8'].query().count() == 0
+
+    def test_models_engine_kwargs(self, models_create, user_models, db_uri):
+        kwargs = {'pool_recycle': 3600, 'pool_pre_ping': True,
+                  'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 2}
+        models = AlquimiaModels(db_uri, user_models, engine_kwargs=kwargs)
+        assert models.metadata.bind.pool._recycle == 3600
+        assert models['t8'].query().count() == 0
+        stats = models.pool_stats.snapshot()
+        assert stats['size'] == 2
+        assert stats['checked_out'] == 1
+        models._session.commit()
+        assert models.pool_stats.snapshot()['checked_out'] == 0
+
+    def test_models_engine_kwargs_with_engine(self, user_models, db_uri):
+        with pytest.raises(TypeError):
+            AlquimiaModels(sqlalchemy.create_engine(db_uri), user_models,
+                           engine_kwargs={'pool_size': 2})
+
+    def test_models_pool_stats_timeout(self, models_create, user_models,
+                                                                      db_uri):
+        kwargs = {'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 1,
+                  'max_overflow': 0, 'pool_timeout': 0.1}
+        models = AlquimiaModels(db_uri, user_models, engine_kwargs=kwargs)
+        conn = models.metadata.bind.connect()
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            models['t8'].query().count()
+        conn.close()
+        stats = models.pool_stats.snapshot()
+        assert stats['timeouts'] == 1
+        assert stats['checkouts'] == 1
+        assert stats['max_wait'] >= 0.1
+
+    def test_models_pool_stats_engine_connect(self, models_create,
+                                                      user_models, db_uri):
+        kwargs = {'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 1,
+                  'max_overflow': 0, 'pool_timeout': 0.1}
+        models = AlquimiaModels(db_uri, user_models, engine_kwargs=kwargs)
+        engine = models.metadata.bind
+        conn = engine.connect()
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            engine.connect()
+        conn.close()
+        stats = models.pool_stats.snapshot()
+        assert stats['timeouts'] == 1
+        assert stats['max_wait'] >= 0.1
+        models.pool_stats.detach()
+        assert not 'unique_connection' in vars(engine.pool)
+
+    def test_models_pool_stats_shared_engine(self, models_create, user_models,
+                                                                      db_uri):
+        engine = sqlalchemy.create_engine(db_uri)
+        stats = [PoolStats(engine) for i in range(1500)]
+        models = AlquimiaModels(engine, user_models)
+        models['t8'].query().count()
+        assert stats[0].snapshot()['checkouts'] == 1
+        assert models.pool_stats.snapshot()['checkouts'] == 1
+        for each in stats:
+            each.detach()
+        models.pool_stats.detach()
+        assert not 'connect' in vars(engine.pool)
+        assert not 'unique_connection' in vars(engine.pool)
+        models._session.commit()
+        models['t8'].query().count()
+        assert models.pool_stats.snapshot()['checkouts'] == 1
+
+    def test_models_filters_cache_stats(self, models_create, user_models,
+                                                                      db_uri):
+        models = AlquimiaModels(db_uri, user_models, filters_cache_size=1)
+        models['t8'].query({'c8': 'test'})
+        models['t8'].query({'c8': 'test'})
+        models['t8'].query({'id': 1})
+        stats = models.filters_cache_stats()['t8']
+        assert stats == {'size': 1, 'max_size': 1, 'hits': 1, 'misses': 2}
+
+    def test_models_indexes(self, db_uri):
+        dict_ = {
+            'person': {
+                'name': 'string',
+                'age': {'type': 'integer', 'index': True},
+                'relationships': ['address', {'tag': 'many-to-many'}],
+                'indexes': [
+                    'name', ['name', 'age'],
+                    {'columns': 'age', 'unique': True, 'name': 'uq_person_age'}
+                ]
+            },
+            'address': {'street': 'string'},
+            'tag': {'label': 'string'}
+        }
+        models = AlquimiaModels(db_uri, dict_)
+        indexes = {ix.name: ([c.name for c in ix.columns], ix.unique)
+                        for ix in models.metadata.tables['person'].indexes}
+        assert indexes == {
+            'ix_person_name': (['name'], False),
+            'ix_person_name_age': (['name', 'age'], False),
+            'uq_person_age': (['age'], True),
+            'ix_person_age': (['age'], False),
+            'ix_person_address_id': (['address_id'], False)
+        }
+        assoc = models.metadata.tables['person_tag_association']
+        assert [[c.name for c in ix.columns] for ix in assoc.indexes] == \
+                                                                [['person_id']]
+
+    def test_models_indexes_where(self):
+        dict_ = {'person': {'age': 'integer', 'indexes': [
+            {'columns': 'age', 'unique': True, 'where': 'age > 10'}]}}
+        models = AlquimiaModels('sqlite://', dict_, create=True)
+        index = list(models.metadata.tables['person'].indexes)[0]
+        assert str(index.dialect_options['sqlite']['where']) == 'age > 10'
+        models['person'].insert([{'age': 5}, {'age': 5}, {'age': 11}])
+        with pytest.raises(sqlalchemy.exc.IntegrityError):
+            models['person'].insert({'age': 11})
+
+    def test_models_indexes_where_unsupported(self):
+        engine = sqlalchemy.create_engine('mysql://', strategy='mock',
+                                          executor=lambda *args, **kw: None)
+        dict_ = {'person': {'age': 'integer', 'indexes': [
+            {'columns': 'age', 'unique': True, 'where': 'age > 10'}]}}
+        with pytest.raises(TypeError):
+            ModelsAttributes(dict_, sqlalchemy.MetaData(engine))
+
+    def test_models_indexes_invalid(self, db_uri):
+        with pytest.raises(ValidationError):
+            AlquimiaModels(db_uri, {'t': {'c': 'string',
+                                          'indexes': [{'name': 'ix'}]}})
+
+    def test_models_cache_definitions(self, models_create, user_models,
+                                                           db_uri, monkeypatch):
+        monkeypatch.setattr(models_attrs, '_DEFINITIONS', {})
+        models = AlquimiaModels(db_uri, user_models, cache_definitions=True)
+        assert len(models_attrs._DEFINITIONS) == 1
+        calls = []
+        monkeypatch.setattr(models_attrs.jsonschema, 'validate',
+                                          lambda *args: calls.append(args))
+        cached = AlquimiaModels(db_uri, user_models, cache_definitions=True)
+        assert not calls
+        self._check_models(cached)
+        assert sorted(cached.keys()) == sorted(models.keys())
+        AlquimiaModels(db_uri, user_models)
+        assert len(calls) == 1
+
+    def test_models_cache_dir(self, models_create, user_models, db_uri,
+                                                          tmpdir, monkeypatch):
+        monkeypatch.setattr(models_attrs, '_DEFINITIONS', {})
+        AlquimiaModels(db_uri, user_models, cache_dir=str(tmpdir))
+        assert len(tmpdir.listdir()) == 1
+        monkeypatch.setattr(models_attrs, '_DEFINITIONS', {})
+        monkeypatch.setattr(models_attrs.jsonschema, 'validate', None)
+        models = AlquimiaModels(db_uri, user_models, cache_dir=str(tmpdir))
+        self._check_models(models)
+        assert len(models_attrs._DEFINITIONS) == 1
+
+    def test_models_reflect_only(self, models_create, db_uri):
+        models = AlquimiaModels(db_uri, reflect_only=['t8'])
+        assert sorted(models.keys()) == ['t1', 't2', 't7', 't8']
+        assert models['t8'].relationships == ['t7']
+        models = AlquimiaModels(db_uri, reflect_only=['t2'])
+        assert sorted(models.keys()) == ['t2', 't6']
+        assert 't2_t6_association' in models.metadata.tables
+
+    def test_models_reflect_pattern(self, models_create, db_uri):
+        models = AlquimiaModels(db_uri, reflect_pattern='t[78]$')
+        assert sorted(models.keys()) == ['t1', 't2', 't7', 't8']
+
+    def test_models_reflect_lazy(self, models_create, models_reflect,
+                                                                     db_uri):
+        models = AlquimiaModels(db_uri, lazy=True)
+        assert models.keys() == []
+        t7 = models['t7']
+        assert sorted(models.keys()) == ['t1', 't2', 't7']
+        assert t7.relationships == ['t1']
+        t8 = models['t8']
+        assert sorted(t7.relationships) == ['t1', 't8']
+        assert t7['t8'].model is t8
+        for model_name in models_reflect:
+            models[model_name]
+        for model_name, model in models_reflect.iteritems():
+            assert sorted(models[model_name].keys()) == sorted(model.keys())
+            assert sorted(models[model_name].relationships) == \
+                                                   sorted(model.relationships)
+        assert sorted(models.keys()) == sorted(models_reflect.keys())
+        with pytest.raises(KeyError):
+            models['invalid']
+
+    def test_models_reflect_lazy_insert(self, models_create, db_uri):
+        models = AlquimiaModels(db_uri, lazy=True)
+        models['t7']
+        t8 = models['t8'].insert({'c8': 'test', 't7': {'c7': 'test'}})
+        assert t8.todict()['t7']['c7'] == 'test'
+        assert models['t7'].query().one().todict()['t8'][0]['c8'] == 'test'
+
+    def test_models_reflect_snapshot(self, models_create, models_reflect,
+                                                db_uri, tmpdir, monkeypatch):
+        snapshot = str(tmpdir.join('snapshot'))
+        AlquimiaModels(db_uri, reflect_snapshot=snapshot)
+        monkeypatch.setattr(sqlalchemy.MetaData, 'reflect', None)
+        models = AlquimiaModels(db_uri, reflect_snapshot=snapshot)
+        assert sorted(models.keys()) == sorted(models_reflect.keys())
+        for model_name, model in models_reflect.iteritems():
+            assert sorted(models[model_name].keys()) == sorted(model.keys())
+            for rel_type in ['mtm', 'mto', 'oto', 'otm']:
+                assert sorted(getattr(models[model_name], rel_type)) == \
+                                             sorted(getattr(model, rel_type))
+        t8 = models['t8'].insert({'c8': 'test', 't7': {'c7': 'test'}})
+        assert t8.todict()['t7']['c7'] == 'test'
+
+    def test_models_reflect_snapshot_invalidated(self, models_create, db_uri,
+                                                                      tmpdir):
+        snapshot = str(tmpdir.join('snapshot'))
+        AlquimiaModels(db_uri, reflect_snapshot=snapshot)
+        engine = models_create.metadata.bind
+        engine.execute('CREATE TABLE t9 (id INTEGER PRIMARY KEY)')
+        try:
+            models = AlquimiaModels(db_uri, reflect_snapshot=snapshot)
+            assert 't9' in models
+        finally:
+            engine.execute('DROP TABLE t9')
+        models = AlquimiaModels(db_uri, reflect_snapshot=snapshot)
+        assert 't9' not in models
+
+    def test_models_operation_stats(self, models, t8_t7_obj):
+        models.operation_stats.reset()
+        models['t8'].insert(t8_t7_obj)
+        models.clean()
+        t8 = models['t8'].query().one()
+        t8.todict()
+        models['t8'].count()
+        models['t8'].delete(t8['id'])
+        stats = models.operation_stats.snapshot()
+        operations = stats['operations']
+        assert sorted(operations.keys()) == ['t8.count', 't8.delete',
+                                       't8.insert', 't8.query', 't8.todict']
+        assert operations['t8.insert']['statements'] == 2
+        assert operations['t8.insert']['rows'] == 2
+        assert operations['t8.query']['statements'] == 1
+        assert operations['t8.query']['rows'] == 1
+        assert operations['t8.todict']['statements'] >= 1
+        assert operations['t8.todict']['rows'] >= 1
+        assert operations['t8.count']['rows'] == 1
+        assert operations['t8.delete']['rows'] == 1
+        assert operations['t8.delete']['calls'] == 1
+        assert stats['statements'] == sum(
+            [op['statements'] for op in operations.values()]) + \
+                                              stats['unattributed_statements']
+
+    def test_models_operation_stats_shared_engine(self, models_create,
+                                                      user_models, db_uri):
+        engine = sqlalchemy.create_engine(db_uri)
+        stats = [OperationStats(engine, None) for i in range(1500)]
+        models = AlquimiaModels(engine, user_models)
+        assert len(engine.dispatch.after_cursor_execute) == 1
+        models['t8'].count()
+        assert stats[0].snapshot()['statements'] == 1
+        assert models.operation_stats.snapshot()['statements'] == 1
+        for each in stats:
+            each.detach()
+        models.operation_stats.detach()
+        assert len(engine.dispatch.after_cursor_execute) == 0
+
+    def test_models_operation_stats_nested(self, models, person_models):
+        person = person_models['person']
+        person_models.operation_stats.reset()
+        person.upsert({'email': 'a', 'name': 'A', 'address': {'street': 's'}},
+                                                                      'email')
+        operations = person_models.operation_stats.snapshot()['operations']
+        assert operations.keys() == ['person.upsert']
+
+    def test_models_operation_stats_slow(self, models_create, user_models,
+                                                              db_uri, caplog):
+        models = AlquimiaModels(db_uri, user_models, slow_threshold=0)
+        with pytest.raises(TypeError):
+            models['t8'].delete('invalid')
+        stats = models.operation_stats.snapshot()
+        assert stats['slow_operations'] == 1
+        assert stats['operations']['t8.delete']['errors'] == 1
+        assert caplog.records()[-1].msg.startswith(
+                                           'alquimia:Slow operation t8.delete')
+
+    def test_models_cache(self, models_create, user_models, db_uri,
+                                                         t8_t7_obj, statements):
+        cache = MemoryCache()
+        models = AlquimiaModels(db_uri, user_models, cache=cache)
+        t8 = models['t8'].insert(t8_t7_obj)
+        t8_dict = models['t8'].get_cached(t8['id'], depth=1)
+        assert t8_dict['t7']['c7'] == 'test17'
+        assert models['t8'].query_cached({'c8': 'test18'}, depth=0) == \
+                                           [{'id': t8['id'], 'c8': 'test18'}]
+        models.clean()
+        del statements[:]
+        assert models['t8'].get_cached(t8['id'], depth=1) == t8_dict
+        assert models['t8'].query_cached({'c8': 'test18'}, depth=0) == \
+                                           [{'id': t8['id'], 'c8': 'test18'}]
+        assert statements == []
+        # the row version of the get_cached entry is a cache hit too
+        assert cache.stats()['hits'] == 3
+
+        models['t7'].update({'id': t8['t7']['id'], 'c7': 'test27'})
+        assert models['t8'].get_cached(t8['id'], depth=1)['t7']['c7'] == \
+                                                                      'test27'
+        assert models['t8'].query_cached({'c8': 'test18'}, depth=0) == \
+                                           [{'id': t8['id'], 'c8': 'test18'}]
+        assert cache.stats()['hits'] == 5
+        models['t8'].delete(t8['id'])
+        assert models['t8'].query_cached({'c8': 'test18'}, depth=0) == []
+
+    def test_models_cache_rows(self, models_create, user_models, db_uri):
+        models = AlquimiaModels(db_uri, user_models, cache=MemoryCache())
+        stats = models.operation_stats
+        t7s = models['t7'].insert([{'c7': 'test17'}, {'c7': 'test27'}])
+        ids = [t7['id'] for t7 in t7s]
+        assert models['t7'].get_cached(ids[0], depth=0)['c7'] == 'test17'
+        assert models['t7'].get_cached(str(ids[1]), depth=0)['c7'] == 'test27'
+        models['t7'].update({'id': ids[1], 'c7': 'test37'})
+        models['t7'].bulk_update({'id': ids[1], 'c7': 'test47'})
+        models['t7'].insert({'c7': 'test57'})
+        stats.reset()
+        assert models['t7'].get_cached(ids[0], depth=0)['c7'] == 'test17'
+        assert stats.snapshot()['statements'] == 0
+        assert models['t7'].get_cached(ids[1], depth=0)['c7'] == 'test47'
+        assert stats.snapshot()['statements'] == 1
+        models['t7'].delete_where({'c7': 'test57'})
+        stats.reset()
+        assert models['t7'].get_cached(ids[0], depth=0)['c7'] == 'test17'
+        assert stats.snapshot()['statements'] == 1
+
+    def test_models_cache_instance_filter(self, models_create, user_models,
+                                                       db_uri, t8_t7_obj):
+        cache = MemoryCache()
+        models = AlquimiaModels(db_uri, user_models, cache=cache)
+        t8 = models['t8'].insert(t8_t7_obj)
+        t7 = t8['t7']
+        assert models['t8'].query_cached({'t7': t7}, depth=0) == \
+                                           [{'id': t8['id'], 'c8': 'test18'}]
+        assert models['t8'].query_cached({'t7': t7}, depth=0) == \
+                                           [{'id': t8['id'], 'c8': 'test18'}]
+        assert cache.stats()['hits'] == 1
+        models['t8'].delete(t8['id'])
+        models['t7'].delete(t7['id'])
+
+    def test_models_cache_bulk(self, models_create, user_models, db_uri,
+                                                                    t8_t7_obj):
+        models = AlquimiaModels(db_uri, user_models, cache=SharedCache('test'))
+        query = {'t7': {'c7': 'test17'}}
+        assert models['t8'].query_cached(query) == []
+        models['t8'].bulk_insert(t8_t7_obj)
+        assert len(models['t8'].query_cached(query)) == 1
+        other = AlquimiaModels(db_uri, user_models, cache=SharedCache('test'))
+        other['t7'].delete_where({'c7': 'test17'})
+        assert models['t8'].query_cached(query) == []
+
+    def test_models_session_per_operation(self, models_create, user_models,
+                                                            db_uri, t8_t7_obj):
+        models = AlquimiaModels(db_uri, user_models,
+                                session_policy='per_operation')
+        t8 = models['t8'].insert(t8_t7_obj)
+        assert len(models._session.identity_map) == 0
+        assert t8.todict()['t7']['c7'] == 'test17'
+        t8 = models['t8'].query({'id': t8['id']}).one()
+        stats = models.session_lifecycle.snapshot()
+        assert stats['identity_map'] == 0
+        assert stats['peak_identity_map'] >= 2
+        assert stats['sessions_closed'] >= 3
+        assert t8['t7']['c7'] == 'test17'
+
+    def test_models_session_per_operation_stream(self, models_create,
+                                                     user_models, db_uri):
+        models = AlquimiaModels(db_uri, user_models,
+                                session_policy='per_operation')
+        models['t8'].bulk_insert([{'c8': 'stream%d' % i} for i in range(12)])
+        closed = models.session_lifecycle.snapshot()['sessions_closed']
+        rows = []
+        for row in models['t8'].stream({'c8': {'_prefix': 'stream'}},
+                                                                batch_size=5):
+            rows.append(row)
+            assert models['t8'].count({'id': row['id']}) == 1
+        assert len(rows) == 12
+        stats = models.session_lifecycle.snapshot()
+        assert stats['sessions_closed'] == closed + 1
+        models['t8'].delete_where({'c8': {'_prefix': 'stream'}})
+
+    def test_models_session_expunge_on_commit(self, models_create,
+                                         user_models, db_uri, t8_t7_obj):
+        models = AlquimiaModels(db_uri, user_models, scoped=True,
+                                session_policy='expunge_on_commit')
+        t8 = models['t8'].insert(t8_t7_obj)
+        assert len(models._session.identity_map) == 0
+        assert t8['c8'] == 'test18'
+        t8s = models['t8'].query().all()
+        assert len(models._session.identity_map) == len(t8s)
+        with models.unit_of_work():
+            t8 = models['t8'].insert(t8_t7_obj)
+            assert len(models._session.identity_map) == len(t8s) + 2
+        assert len(models._session.identity_map) == 0
+        assert models.session_lifecycle.snapshot()['expunged'] == \
+                                                               4 + len(t8s)
+
+    def test_models_session_max_identity_map(self, models_create,
+                                             user_models, db_uri, t8_t7_obj):
+        models = AlquimiaModels(db_uri, user_models, max_identity_map=2)
+        models['t8'].bulk_insert([t8_t7_obj] * 5)
+        t8s = models['t8'].query().all()
+        assert len(models._session.identity_map) == 2
+        assert [t8.todict(depth=1)['t7']['c7'] for t8 in t8s] == \
+                                                     ['test17'] * len(t8s)
+        assert len(models._session.identity_map) <= 2
+        assert models.session_lifecycle.snapshot()['evictions'] >= 3
+
+    @pytest.mark.parametrize('policy', ['shared', 'per_operation',
+                                        'expunge_on_commit'])
+    def test_models_session_save(self, models_create, user_models, db_uri,
+                                                                     policy):
+        models = AlquimiaModels(db_uri, user_models, session_policy=policy)
+        t8 = models['t8'].insert({'c8': 'save18'})
+        t8['c8'] = 'save28'
+        t8.save()
+        models.clean()
+        t8 = models['t8'].query({'id': t8['id']}).one()
+        assert t8['c8'] == 'save28'
+        t8['c8'] = 'save38'
+        t8.save()
+        models.clean()
+        assert models['t8'].query({'id': t8['id']}).one()['c8'] == 'save38'
+        models['t8'].delete(t8['id'])
+
+    def test_models_session_policy_invalid(self, user_models, db_uri):
+        with pytest.raises(TypeError):
+            AlquimiaModels(db_uri, user_models, session_policy='invalid')